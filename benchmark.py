@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import concurrent.futures
+from datetime import datetime
+import math
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import remindmebot
+
+### FAKE DISCORD ###
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = remindmebot.mention(user_id)
+
+class FakeChannel:
+    def __init__(self, channel_id, simulation=None):
+        self.id = channel_id
+        self.name = 'channel {0}'.format(channel_id)
+        self.guild = None
+        # every message sent to the channel is handed to the simulation
+        self.simulation = simulation
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(self.simulation.next_message_id(), content, None, self)
+        self.simulation.received(self.id, message)
+        return message
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel, guild=None):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        # naive UTC like discord.py's
+        self.created_at = datetime.utcnow()
+
+    async def add_reaction(self, emoji):
+        return
+
+class FakeClient:
+    def __init__(self, user_id, channels={}):
+        self.user = FakeUser(user_id)
+        self.channels = channels
+        self.http = FakeHttp()
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeHttp:
+    async def delete_message(self, channel_id, message_id):
+        return
+
+class FakeEmoji:
+    def __init__(self, name):
+        self.name = name
+
+class FakeReaction:
+    def __init__(self, user_id, channel_id, message_id, emoji):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.emoji = FakeEmoji(emoji)
+
+# stands in for MessageDispatcher, messages are not sent anywhere
+class NullDispatcher:
+    def __init__(self):
+        self.message_ids = iter(range(10**12, 10**13))
+
+    async def send(self, channel_id, content, description=None, coalesce=False):
+        return FakeMessage(next(self.message_ids), content, None, FakeChannel(channel_id))
+
+    async def delete(self, channel_id, message_id):
+        return
+
+    async def edit(self, channel_id, message_id, content, description=None):
+        return
+
+    def queue_depth(self):
+        return 0
+
+### PARSING ###
+
+# typical reminder commands, most use a handful of relative times
+parse_samples = ['rmb stand up in 30 minutes',
+                 'rmb take out the trash tomorrow',
+                 'remind check the oven in 2 hours',
+                 'rmb in an hour',
+                 'rmb drink water in 45 minutes',
+                 'rmb pay rent in 3 days and 2 hours',
+                 'remind <@!1234> call mom at 5pm tomorrow',
+                 'rmb dentist on march 3rd at 10am',
+                 'rmb stand up in 30 minutes',
+                 'rmb pay rent in 3 days and 2 hours']
+
+def benchmark_parse(rounds):
+    now = time.time()
+    # current path: every message goes through dateparser
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for content in parse_samples:
+            remindmebot.parse_message(remindmebot.remove_prefix(content), now)
+    baseline = (time.perf_counter() - start) / (rounds * len(parse_samples))
+    # tiered path: fast path, then the cache, then dateparser on a miss
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for content in parse_samples:
+            removed_prefix = remindmebot.remove_prefix(content)
+            if remindmebot.lookup_parse(removed_prefix) == None:
+                reminder_messages, offsets, relative = remindmebot.parse_message(removed_prefix, now)
+                if relative:
+                    remindmebot.cache_parse(removed_prefix, reminder_messages, offsets)
+    tiered = (time.perf_counter() - start) / (rounds * len(parse_samples))
+    print('dateparser only: {0:.1f} us/message'.format(baseline * 1e6))
+    print('tiered parser:   {0:.1f} us/message ({1:.1f}x)'.format(tiered * 1e6, baseline / tiered))
+    print('fast path: {fast} cache hits: {hits} cache misses: {misses}'.format(**remindmebot.parse_stats))
+    return
+
+### MEMORY ###
+
+# the reminder layout before __slots__ and epoch times, for comparison
+class LegacyReminder:
+    def __init__(self, user_id, message_id, channel_id, creation_time, reminder_time, info='', confirmation_id=None):
+        self.user_id = user_id
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.creation_time = creation_time
+        self.reminder_time = reminder_time
+        self.info = info
+        self.confirmation_id = confirmation_id
+
+def build_legacy_reminder(i, now):
+    return LegacyReminder(1000 + i % 500, 10**17 + i, 10**16 + i % 50,
+                          remindmebot.format_time(now), remindmebot.format_time(now + i),
+                          'reminder {0}'.format(i), 10**17 + 2 * i)
+
+def build_reminder(i, now):
+    return remindmebot.Reminder(1000 + i % 500, 10**17 + i, 10**16 + i % 50,
+                                now, now + i, 'reminder {0}'.format(i), 10**17 + 2 * i)
+
+def measure_reminders(build, count):
+    now = time.time()
+    tracemalloc.start()
+    reminders = [build(i, now) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del reminders
+    return size / count
+
+# what the bot pays per reminder: the reminder, its entries in the store's indexes and its scheduler heap entry
+# every reminder is scheduled, as if all of them were due inside the scheduler's window
+def measure_stored_reminders(count):
+    now = time.time()
+    with tempfile.TemporaryDirectory() as directory:
+        tracemalloc.start()
+        store = remindmebot.MemoryStore(os.path.join(directory, 'journal'), os.path.join(directory, 'snapshot'))
+        for i in range(count):
+            reminder = build_reminder(i, now)
+            store.insert(reminder)
+            remindmebot.schedule_reminder(reminder)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del store, reminder
+    remindmebot.scheduled_reminders.clear()
+    remindmebot.reminder_heap.clear()
+    return size / count
+
+def benchmark_memory(counts):
+    for count in counts:
+        before = measure_reminders(build_legacy_reminder, count)
+        after = measure_reminders(build_reminder, count)
+        stored = measure_stored_reminders(count)
+        print('{0:>8} reminders: {1:.0f} bytes/reminder before, {2:.0f} bytes/reminder after, {3:.0f} bytes/reminder stored and scheduled'.format(count, before, after, stored))
+    return
+
+### ROUTER ###
+
+# mostly ordinary chat, with some reminders and commands mixed in
+def build_traffic(count):
+    generator = random.Random(0)
+    users = [FakeUser(1000 + i) for i in range(50)]
+    channel = FakeChannel(1)
+    chatter = ['lol', 'did anyone see the game last night', 'brb', 'remember to push your changes', 'ok sounds good']
+    commands = ['rmb help', 'rmb list', 'remind delete 1', 'rmb delete all', 'rmb clear 2 hours', 'rmb stand up in 30 minutes', 'remindme take out the trash tomorrow']
+    traffic = []
+    for i in range(count):
+        content = generator.choice(commands) if generator.random() < 0.15 else generator.choice(chatter)
+        traffic.append(FakeMessage(i, content, generator.choice(users), channel))
+    return traffic
+
+async def route_traffic(traffic):
+    for message in traffic:
+        await remindmebot.on_message(message)
+    return
+
+def benchmark_router(count):
+    # everything on_message hands off is replaced so only routing is measured
+    async def handed_off(message, *args, **kwargs):
+        return
+    remindmebot.create_reminders = handed_off
+    remindmebot.clear_messages = handed_off
+    remindmebot.client = FakeClient(1)
+    remindmebot.dispatcher = NullDispatcher()
+    remindmebot.store = remindmebot.MemoryStore(os.devnull, os.devnull)
+    remindmebot.accepting_messages = True
+    traffic = build_traffic(count)
+    loop = asyncio.new_event_loop()
+    start = time.perf_counter()
+    loop.run_until_complete(route_traffic(traffic))
+    elapsed = time.perf_counter() - start
+    loop.close()
+    print('{0} messages in {1:.3f} seconds: {2:.0f} messages/second through on_message'.format(count, elapsed, count / elapsed))
+    return
+
+### SIMULATION ###
+
+# reminder messages in the lines of a (possibly coalesced) fired reminder message
+fired_pattern = re.compile(r'Reminder for "(.*?)" from')
+
+# N users each taking M actions against the real on_message, on_raw_reaction_add, create_reminders and scheduler
+# every user waits for the bot's answer before their next action, so latency is measured per command
+class Simulation:
+    def __init__(self, users, actions, channels, horizon, burst, seed):
+        self.users = users
+        self.actions = actions
+        self.channels = {channel_id : FakeChannel(channel_id, self) for channel_id in range(1, channels + 1)}
+        self.horizon = horizon
+        self.burst = burst
+        self.seed = seed
+        self.message_ids = iter(range(10**12, 10**13))
+        # (channel ID, mention) -> future for the answer the user is waiting for
+        self.pending = {}
+        # reminder message -> due timestamp, for reminders that have not fired yet
+        self.due = {}
+        self.latencies = {'create' : [], 'list' : [], 'delete' : []}
+        self.lags = []
+        self.timeouts = 0
+
+    def next_message_id(self):
+        return next(self.message_ids)
+
+    def received(self, channel_id, message):
+        fired = fired_pattern.findall(message.content)
+        for info in fired:
+            if info in self.due:
+                self.lags.append(time.time() - self.due.pop(info))
+        if len(fired) > 0:
+            return
+        future = self.pending.pop((channel_id, message.content.split(' ', 1)[0]), None)
+        if future != None and not future.done():
+            future.set_result(message)
+        return
+
+    async def command(self, kind, channel, user, handler, argument):
+        future = asyncio.get_event_loop().create_future()
+        self.pending[(channel.id, user.mention)] = future
+        start = time.perf_counter()
+        await handler(argument)
+        try:
+            answer = await asyncio.wait_for(future, 10)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        self.latencies[kind].append(time.perf_counter() - start)
+        return answer
+
+    async def run_user(self, index):
+        # one generator per user so the actions do not depend on how the users are interleaved
+        generator = random.Random(self.seed * 1000003 + index)
+        user = FakeUser(1000 + index)
+        channel = self.channels[1 + index % len(self.channels)]
+        # reminders that can still be deleted
+        confirmations = []
+        for action in range(self.actions):
+            roll = generator.random()
+            upcoming = [reminder for reminder in confirmations if reminder.reminder_time > time.time() + 1 and reminder.confirmation_id != None]
+            if roll < 0.1:
+                message = FakeMessage(self.next_message_id(), 'rmb list', user, channel)
+                await self.command('list', channel, user, remindmebot.on_message, message)
+            elif roll < 0.2 and len(upcoming) > 0:
+                confirmations.remove(upcoming[0])
+                del self.due[upcoming[0].info]
+                reaction = FakeReaction(user.id, channel.id, upcoming[0].confirmation_id, remindmebot.emojis[0])
+                await self.command('delete', channel, user, remindmebot.on_raw_reaction_add, reaction)
+            else:
+                # only letters so the message stays on the fast path, ex: "task xbcyd"
+                info = 'task x' + ''.join('abcdefghij'[int(digit)] for digit in str(index)) + 'y' + ''.join('abcdefghij'[int(digit)] for digit in str(action))
+                if generator.random() < self.burst:
+                    # everything in the burst is due in the same second, like reminders set for the top of the hour
+                    delay = max(1, math.ceil(self.burst_time - time.time()))
+                else:
+                    delay = generator.randint(1, self.horizon)
+                message = FakeMessage(self.next_message_id(), 'rmb {0} in {1} seconds'.format(info, delay), user, channel)
+                answer = await self.command('create', channel, user, remindmebot.on_message, message)
+                reminder = remindmebot.store.find_user_reminder(user.id, info) if answer != None else None
+                if reminder != None:
+                    self.due[info] = reminder.reminder_time
+                    confirmations.append(reminder)
+        return
+
+    async def run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.set_up(directory)
+            self.burst_time = time.time() + self.horizon
+            start = time.perf_counter()
+            await asyncio.gather(*[self.run_user(index) for index in range(self.users)])
+            self.elapsed = time.perf_counter() - start
+            # wait for every reminder to fire
+            deadline = time.time() + self.horizon + 30
+            while len(self.due) > 0 and time.time() < deadline:
+                await asyncio.sleep(0.1)
+            await self.tear_down()
+        return
+
+    def set_up(self, directory):
+        remindmebot.client = FakeClient(1, self.channels)
+        remindmebot.dispatcher = remindmebot.MessageDispatcher(remindmebot.client.get_channel, remindmebot.client.http)
+        remindmebot.catch_up_slots = asyncio.Semaphore(remindmebot.catch_up_concurrency)
+        remindmebot.scheduler_wakeup = asyncio.Event()
+        remindmebot.store = remindmebot.MemoryStore(os.path.join(directory, 'journal'), os.path.join(directory, 'snapshot'))
+        remindmebot.store.load(time.time() + remindmebot.schedule_window)
+        remindmebot.page_in_reminders(time.time())
+        remindmebot.scheduler_task = asyncio.create_task(remindmebot.run_scheduler())
+        remindmebot.accepting_messages = True
+        return
+
+    async def tear_down(self):
+        remindmebot.scheduler_task.cancel()
+        await asyncio.wait([remindmebot.scheduler_task])
+        remindmebot.store.close()
+        return
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def benchmark_simulate(users, actions, channels, horizon, burst, seed, rate_limits):
+    if not rate_limits:
+        # discord's rate limits would make the bot's own costs invisible
+        remindmebot.channel_send_rate = remindmebot.channel_send_burst = remindmebot.global_send_rate = 10**9
+        remindmebot.channel_delete_rate = remindmebot.channel_delete_burst = 10**9
+    # every user can keep all of their reminders
+    remindmebot.reminder_limit = actions + 1
+    simulation = Simulation(users, actions, channels, horizon, burst, seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    remindmebot.start_parser_pool()
+    loop.run_until_complete(simulation.run())
+    remindmebot.parser_pool.shutdown()
+    loop.close()
+    commands = sum([len(latencies) for latencies in simulation.latencies.values()])
+    print('{0} users x {1} actions in {2} channels, seed {3}: {4} created, {5} listed, {6} deleted, {7} timed out'.format(
+        users, actions, channels, seed, len(simulation.latencies['create']), len(simulation.latencies['list']), len(simulation.latencies['delete']), simulation.timeouts))
+    print('throughput:      {0:.0f} commands/second'.format(commands / simulation.elapsed))
+    for kind in ['create', 'list', 'delete']:
+        print('{0:<16} p50 {1:7.2f} ms  p99 {2:7.2f} ms'.format(kind + ' latency:', percentile(simulation.latencies[kind], 0.5) * 1000, percentile(simulation.latencies[kind], 0.99) * 1000))
+    print('scheduler lag:   p50 {0:7.2f} ms  p99 {1:7.2f} ms  max {2:7.2f} ms ({3} fired, {4} never fired)'.format(
+        percentile(simulation.lags, 0.5) * 1000, percentile(simulation.lags, 0.99) * 1000, max(simulation.lags + [0]) * 1000, len(simulation.lags), len(simulation.due)))
+    # kilobytes on linux
+    print('peak RSS:        {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    return
+
+### STARTUP ###
+
+# runs in a fresh interpreter started by benchmark_startup, start is taken before remindmebot is imported
+def startup_child(start):
+    imported = time.perf_counter()
+    import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        remindmebot.store = remindmebot.MemoryStore(os.path.join(directory, 'journal'), os.path.join(directory, 'snapshot'))
+        remindmebot.store.load(time.time() + remindmebot.schedule_window)
+        remindmebot.start_parser_pool()
+        # ready once the parsers can take a message, a worker runs warm_parser as its initializer before its first task
+        concurrent.futures.wait([remindmebot.parser_pool.submit(int) for _ in range(remindmebot.parser_workers)])
+        ready = time.perf_counter()
+        bot_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        remindmebot.parser_pool.shutdown()
+        loop.close()
+    # largest parser process, children are only counted once they have exited
+    parser_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(imported - start, ready - start, import_rss, bot_rss, parser_rss)
+    return
+
+def benchmark_startup(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', 'import time; start = time.perf_counter(); import benchmark; benchmark.startup_child(start)'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True).stdout
+        results.append([float(value) for value in output.split()[-5:]])
+    # medians, RSS is in kilobytes on linux
+    imported, ready, import_rss, bot_rss, parser_rss = [sorted(column)[len(column) // 2] for column in zip(*results)]
+    print('import:     {0:.3f} seconds, {1:.1f} MB RSS'.format(imported, import_rss / 1024))
+    print('ready:      {0:.3f} seconds, {1:.1f} MB RSS in the bot process'.format(ready, bot_rss / 1024))
+    print('parsers:    {0:.1f} MB RSS in the largest of {1} parser processes'.format(parser_rss / 1024, remindmebot.parser_workers))
+    return
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the reminder bot.')
+    parser.add_argument('benchmark', choices=['parse', 'memory', 'router', 'simulate', 'startup'])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--actions', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=20)
+    # reminders are due 1 to horizon seconds after they are created
+    parser.add_argument('--horizon', type=int, default=10)
+    # fraction of reminders due in the same second at the end of the horizon
+    parser.add_argument('--burst', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate-limits', action='store_true')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    if args.benchmark == 'parse':
+        # warm up dateparser's language data so it is not counted
+        remindmebot.warm_parser()
+        benchmark_parse(args.rounds)
+    elif args.benchmark == 'memory':
+        benchmark_memory(args.counts)
+    elif args.benchmark == 'router':
+        benchmark_router(args.messages)
+    elif args.benchmark == 'simulate':
+        benchmark_simulate(args.users, args.actions, args.channels, args.horizon, args.burst, args.seed, args.rate_limits)
+    elif args.benchmark == 'startup':
+        benchmark_startup(args.runs)
+
+if __name__ == "__main__": main()
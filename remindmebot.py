@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 import asyncio
-from dateparser import parse
-from dateparser.search import search_dates
+import bisect
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
 import time
 import discord
-import multiprocessing
+import heapq
+import itertools
 import os
 import pickle
+import pytz
 import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
 
 ### TODO ###
 # need to add catching exceptions for DM reminders
@@ -16,29 +25,94 @@ import re
 
 ### GLOBAL VARIABLES ###
 
+# set by the supervisor for each shard process, see run_supervisor
+# each shard process connects one discord shard and keeps the reminders of that shard's guilds (DMs go to shard 0)
+# guilds move between shards when the shard count changes, so keep it the same once reminders exist
+shard_count = int(os.environ.get('RMB_SHARD_COUNT', 1))
+shard_id = int(os.environ.get('RMB_SHARD_ID', 0))
+# a shard exiting with this code is updated before it is restarted
+restart_exit_code = 3
+# seconds the supervisor waits before restarting a shard that exited
+shard_restart_delay = 5
+exit_code = 0
+
+# restarts start the new process next to the old one, the old one hands its reminders over once the new one is connected
+handoff_socket = "handoff.sock"
+# seconds to wait for the other process during a handoff
+handoff_timeout = 60
+# seconds the old process waits for running tasks before cancelling them, the new process waits this plus handoff_timeout
+# so it never opens the store while the old process is still saving it
+handoff_drain_timeout = 30
+# False while this process is waiting for a handoff or handing off, messages and reactions are left to the other process
+accepting_messages = False
+# running create_reminders and fire_reminders tasks, a handoff waits for them
+creation_tasks = set()
+firing_tasks = set()
+# reminder ID -> due time, or the time it was taken off the heap for digest reminders, for reminders taken off the heap but not finished yet
+firing_reminders = collections.OrderedDict()
+storage_task = None
+
+# reminders fired more than this many seconds late are sent as a digest per channel and user
+late_threshold = 60
+# digests being sent at once
+catch_up_concurrency = 5
+catch_up_slots = None
+
+# prometheus metrics are served on this port (plus the shard ID) of metrics_host, None turns the endpoint off
+metrics_host = '127.0.0.1'
+metrics_port = 9464
+# seconds to wait for a metrics request
+metrics_timeout = 5
+# the metrics are also written to this file every metrics_interval seconds, None to not write them
+metrics_file = None
+metrics_interval = 15
+# upper bounds in seconds of the histogram buckets
+histogram_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+# the sampling profiler is started and stopped by sending the process SIGUSR1, its samples are written to profile_file when it stops
+profiler = None
+profile_interval = 0.005
+profile_file = "profile.txt"
+
 # api tokens
 discord_token=None
 
 # the text file that the tokens are stored in
 tokens_file = "tokens.txt"
+# where reminders are stored, 'journal' keeps every reminder in memory and 'sqlite' keeps them in database_file
+storage_backend = 'journal'
+store = None
 # pickle file where persistent reminders are stored in
 save_file = "saved_reminders.pkl"
+# append only log of reminder events since save_file was last written
+journal_file = "reminders.journal"
+# sqlite database used by the 'sqlite' storage backend
+database_file = "reminders.db"
+# seconds between fsyncs of the journal / commits of the database
+journal_flush_interval = 1
+# the journal is compacted into save_file after this many events or this many seconds
+compaction_entries = 10000
+compaction_interval = 3600
 
 # message prefixes the bot will respond to
 # index [0] is the default
 bot_prefixes = ['rmb','remind']
+# matches messages starting with any prefix
+prefix_pattern = re.compile('|'.join(map(re.escape, bot_prefixes)), re.IGNORECASE)
 
 # list of emojis for reaction options
-emojis = ['🇦','🇧','🇨','🇩','🇪']
+emojis = ['🇦','🇧','🇨','🇩','🇪','🇫']
 
-commands = ['clear','delete','help','list','restart']
+commands = ['clear','delete','help','list','restart','timezone']
 # parallel arrays; need to match indices
-help_messages = [' \"clear\" : Deletes commands issued to the bot and messages sent by the bot in the current channel (Up to 500 messages back).',
+help_messages = [' \"clear [Number of messages/Time range]\" : Deletes commands issued to the bot and messages sent by the bot in the current channel (Up to 500 messages back by default).'
+                     '\nEx: \"clear 100\" checks the last 100 messages and \"clear 2 hours\" checks the messages from the last 2 hours.',
                  ' \"delete <Reminder>/all\" : Deletes the specified reminder / all of your reminders.'
                      '\nYou can specify a reminder using its reminder message or its number on the \"reminders\" list',
                  ' \"help\" : Sends the help message.',
                  ' \"list\" : Sends a list of your active reminders.',
-                 ' \"restart\" : Restarts and updates the bot.']
+                 ' \"restart\" : Restarts and updates the bot.',
+                 ' \"timezone [Timezone]\" : Sets the timezone your reminders are parsed and shown in / shows your current timezone.'
+                     '\nEx: \"timezone America/New_York\" or \"timezone Europe/London\".']
 
 # in the order they appear
 confirmation_options = ['Delete this reminder (Will also delete both messages).',
@@ -46,56 +120,277 @@ confirmation_options = ['Delete this reminder (Will also delete both messages).'
                         'Delete the message that created this reminder.',
                         'Delete both messages.']
 
-# Reminder -> asyncio task running the reminder
-reminder_tasks = {}
-# user -> Reminder[]
-user_reminders = {}
+# Reminder -> [due timestamp, tie breaker, Reminder] entry in reminder_heap
+scheduled_reminders = {}
+# min-heap of scheduled reminder entries ordered by due timestamp
+# cancelled entries stay in the heap with their Reminder set to None until popped
+reminder_heap = []
+reminder_counter = itertools.count()
+cancelled_entries = 0
+# set whenever the earliest reminder changes so the scheduler recomputes its sleep
+scheduler_wakeup = None
+scheduler_task = None
+# reminders due in the next schedule_window seconds are paged into the scheduler from the store
+schedule_window = 6 * 3600
+# every reminder due before this timestamp is in the scheduler
+scheduled_until = 0
+# only reminders due in the scheduler's window are loaded before the bot is ready
+# later ones are read this many at a time after it is ready
+stream_batch_size = 1000
+# time main() was called, for measuring time to ready
+start_time = time.time()
+# highest reminder ID handed out so far
+last_reminder_id = 0
+
+# most reminders a user can have, user ID -> limit for users with a different one
+reminder_limit = 100
+user_reminder_limits = {}
+# most reminders the users of a guild can have together, guild ID -> limit for guilds with a different one
+# reminders made in DMs only count against the user's limit
+guild_reminder_limit = 10000
+guild_reminder_limits = {}
+# new reminders are turned away while the next due reminder is this many seconds late or this many messages are waiting to be sent
+admission_lag_limit = 30
+admission_queue_limit = 1000
+# channel ID -> when that channel was last told a reminder was turned away, at most one notice per interval
+admission_notices = collections.OrderedDict()
+admission_notice_interval = 60
+admission_notice_limit = 1000
+
+# how many messages back clear checks by default
+clear_limit = 500
+
+# IDs of the most recent help messages, their reactions send the command's help
+help_message_ids = collections.OrderedDict()
+help_message_limit = 1000
+
+# reactions that turn the page of a list message
+list_emojis = ['◀️','▶️']
+# most reminders shown on one page of the list
+list_page_size = 10
+# user ID -> pages of their reminder list, for the most recent users to list their reminders
+list_cache = collections.OrderedDict()
+list_cache_size = 1000
+# list message ID -> (user ID, page shown), for the most recent list messages with more than one page
+list_message_ids = collections.OrderedDict()
+list_message_limit = 1000
+
+# sends every outgoing message, see MessageDispatcher
+dispatcher = None
+# discord allows 5 messages per 5 seconds in a channel and 50 requests per second overall
+channel_send_rate = 1
+channel_send_burst = 5
+channel_delete_rate = 1
+channel_delete_burst = 5
+global_send_rate = 50
+message_length_limit = 2000
+embed_length_limit = 4096
+embed_color = 9570046
+
+# long lived worker processes that parse reminder messages with dateparser
+parser_pool = None
+parser_workers = 2
+# maximum number of messages being parsed or waiting for a parser at once
+parser_queue_limit = 32
+parser_slots = None
+# settings passed to dateparser for every parse
+parser_settings = {'PREFER_DATES_FROM' : 'future', 'PREFER_DAY_OF_MONTH' : 'first'}
+
+# common relative times handled without dateparser, ex: "in 2 hours", "in a day" or "tomorrow"
+fast_time_pattern = re.compile(r'\bin\s+(\d+|an?)\s+(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?)\b|\btomorrow\b', re.IGNORECASE)
+# words that could be part of a time the fast path does not understand
+date_words_pattern = re.compile(r'\d|\b(?:at|on|in|by|next|last|this|ago|am|pm|noon|midnight|morning|afternoon|evening|night|tonight|today|tomorrow|yesterday'
+                                r'|mon|tue|wed|thu|fri|sat|sun|jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)', re.IGNORECASE)
+# times made only of fixed length units, these parse to the same offset from now every time
+relative_time_pattern = re.compile(r'^(?:in\s+)?(?:(?:\d+|an?)\s*(?:seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?)[\s,]*(?:and\s+)?)+(?:from now)?$', re.IGNORECASE)
+duration_pattern = re.compile(r'(\d+|an?)\s*(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?)', re.IGNORECASE)
+# first letter of a unit -> its length in seconds
+unit_seconds = {'s' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400, 'w' : 604800}
 
-reminder_limit = 20
+# recurring reminders, ex: "every 2 hours", "every other day at 9am", "every weekday at 9am" or "every monday and friday at 17:30"
+# rules are (period, day mask, time of day): a period alone repeats from the first occurrence, a day mask alone picks days of the week,
+# and both together repeat every period of whole days at the time of day
+recurrence_pattern = re.compile(r'\bevery\s+(?:(day|weekday|weekend|(?:(?:mon|tues|wednes|thurs|fri|satur|sun)days?(?:\s*,?\s*(?:and\s+)?)?)+)|(?:(\d+|an?|other)\s+)?(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?))\b'
+                                r'(?:\s*at\s+(?:(noon|midnight)|(\d{1,2})(?::(\d{2}))?\s*(am|pm)?)\b)?', re.IGNORECASE)
+# index is datetime.weekday()
+weekday_names = ['mon', 'tues', 'wednes', 'thurs', 'fri', 'satur', 'sun']
+# bit i is set for reminders that go off on datetime.weekday() == i
+day_masks = {'day' : 0b1111111, 'weekday' : 0b0011111, 'weekend' : 0b1100000}
+# shortest time between two occurrences of a recurring reminder in seconds
+recurrence_min_period = 60
 
-# multiprocessing shared data manager
-manager = multiprocessing.Manager()
+# timezone of users that have not set one, None is the host's local time
+default_timezone = None
+# lowercase name -> pytz name, users only store the pytz name so every user in a timezone shares one string
+timezone_names = {name.lower() : name for name in pytz.all_timezones}
+
+# message without prefix, whitespace collapsed -> (reminder messages, offsets in seconds from the time of parsing)
+# mentions stay in the key because they stay in the reminder messages
+# only messages whose times were all relative are cached
+parse_cache = collections.OrderedDict()
+parse_cache_size = 1024
+parse_stats = {'fast' : 0, 'hits' : 0, 'misses' : 0}
+
+# how older versions stored reminder times, in the local time of the machine
+legacy_time_format = "%H:%M:%S on %b %d, %Y"
 
 ### REMINDER CLASS ####
 
+# times are UTC epoch timestamps, they are only formatted when displayed
 class Reminder:
-    def __init__(self, user_id, message_id, channel_id, creation_time, reminder_time=(datetime.now() + timedelta(days=1)).strftime("%H:%M:%S on %b %d, %Y"), info='', confirmation_id=None):
+    # no per reminder __dict__, this adds up with a lot of reminders
+    __slots__ = ['reminder_id', 'user_id', 'guild_id', 'message_id', 'channel_id', 'creation_time', 'reminder_time', 'info', 'confirmation_id', 'recurrence']
+
+    # guild_id is None for reminders created in DMs
+    # recurrence is None for reminders that go off once, otherwise a (period in seconds, day mask, seconds into the day) rule
+    def __init__(self, user_id, message_id, channel_id, creation_time, reminder_time=None, info='', confirmation_id=None, reminder_id=None, guild_id=None, recurrence=None):
+        self.reminder_id = reminder_id if reminder_id != None else next_reminder_id()
         self.user_id = user_id
+        self.guild_id = guild_id
         self.message_id = message_id
         self.channel_id = channel_id
         self.creation_time = creation_time
+        # defaults to in 1 day
+        if reminder_time == None:
+            reminder_time = time.time() + timedelta(days=1).total_seconds()
         self.reminder_time = reminder_time
         self.info = info
         self.confirmation_id = confirmation_id
+        self.recurrence = recurrence
     
-    def save_reminder(self, file_name):
-        with open(file_name, 'ab') as outfile:
-            pickle.dump(self,outfile, pickle.HIGHEST_PROTOCOL)
-        outfile.close()
-        return
+    def __getstate__(self):
+        return {key : getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        # reminders saved by older versions stored their times as formatted strings
+        for key in ['creation_time', 'reminder_time']:
+            if isinstance(state.get(key), str):
+                state[key] = datetime.strptime(state[key], legacy_time_format).timestamp()
+        # and had no id
+        if state.get('reminder_id') == None:
+            state['reminder_id'] = next_reminder_id()
+        else:
+            seen_reminder_id(state['reminder_id'])
+        for key in self.__slots__:
+            setattr(self, key, state.get(key))
     
     # for use as a dictionary key
     def __hash__(self):
-        return hash((self.message_id, self.reminder_time, self.info))
+        return hash(self.reminder_id)
     
     def __eq__(self, other):
-        if other == None:
+        if not isinstance(other, Reminder):
             return False
-        return (self.message_id, self.reminder_time, self.info) == (other.message_id, other.reminder_time, other.info)
+        return self.reminder_id == other.reminder_id
     
     def __ne__(self, other):
         return not(self == other)
 
     # for debugging
     def to_string(self):
-        print('User ID: {0} Message ID: {1} Channel ID: {2} Time: {3} Info: {4}'.format(self.user_id, self.message_id, self.channel_id, self.reminder_time, self.info))
+        print('Reminder ID: {5} User ID: {0} Message ID: {1} Channel ID: {2} Time: {3} Info: {4}'.format(self.user_id, self.message_id, self.channel_id, format_time(self.reminder_time), self.info, self.reminder_id))
+
+def next_reminder_id():
+    global last_reminder_id
+    last_reminder_id += 1
+    return last_reminder_id
+
+# keeps ids unique after loading saved reminders
+def seen_reminder_id(reminder_id):
+    global last_reminder_id
+    last_reminder_id = max(last_reminder_id, reminder_id)
+    return
 
 ### BUILDING MESSAGES ###
 
+def register_help_message(message_id):
+    global help_message_ids
+    help_message_ids[message_id] = None
+    if len(help_message_ids) > help_message_limit:
+        help_message_ids.popitem(last=False)
+    return
+
+# users do not need to be cached to be mentioned
+def mention(user_id):
+    return '<@{0}>'.format(user_id)
+
+# links to a message without fetching it
+def jump_url(guild_id, channel_id, message_id):
+    return 'https://discord.com/channels/{0}/{1}/{2}'.format(guild_id if guild_id != None else '@me', channel_id, message_id)
+
+def reminder_guild_id(reminder):
+    # reminders saved before guild IDs were stored
+    if reminder.guild_id == None:
+        guild = getattr(client.get_channel(reminder.channel_id), 'guild', None)
+        if guild != None:
+            return guild.id
+    return reminder.guild_id
+
+def reminder_url(reminder):
+    return jump_url(reminder_guild_id(reminder), reminder.channel_id, reminder.message_id)
+
+# ex: "2 days, 3 hours and 4 minutes"
+def format_duration(seconds):
+    parts = []
+    for name, length in [('day', 86400), ('hour', 3600), ('minute', 60)]:
+        amount = int(seconds // length)
+        seconds -= amount * length
+        if amount > 0:
+            parts.append('{0} {1}{2}'.format(amount, name, 's' if amount != 1 else ''))
+    if len(parts) == 0:
+        return 'less than a minute'
+    if len(parts) == 1:
+        return parts[0]
+    return ', '.join(parts[:-1]) + ' and ' + parts[-1]
+
+# zone is a pytz timezone or None for the host's local time
+def format_time(timestamp, zone=None):
+    if zone == None:
+        return datetime.fromtimestamp(timestamp).strftime("%H:%M:%S on %b %d, %Y")
+    return datetime.fromtimestamp(timestamp, zone).strftime("%H:%M:%S %Z on %b %d, %Y")
+
+# wall clock time in a timezone, reminders are only converted from and to UTC timestamps when parsing and displaying them
+def local_datetime(timestamp, zone):
+    if zone == None:
+        return datetime.fromtimestamp(timestamp)
+    return datetime.fromtimestamp(timestamp, zone).replace(tzinfo=None)
+
+def local_timestamp(local, zone):
+    if zone == None or local.tzinfo != None:
+        return local.timestamp()
+    return zone.localize(local).timestamp()
+
+# timezones are kept in the store, with several shards a user's timezone only applies on the shard it was set on
+def user_timezone(user_id):
+    name = store.get_timezone(user_id)
+    if name == None:
+        name = default_timezone
+    if name == None:
+        return None
+    # pytz caches timezones by name
+    return pytz.timezone(name)
+
+# ex: "every 2 hours" or "every monday, friday at 09:30"
+def format_recurrence(rule):
+    period, days, time_of_day = rule
+    if period > 0 and days != 0:
+        return 'every ' + format_duration(period) + ' at {0:02}:{1:02}'.format(time_of_day // 3600, time_of_day % 3600 // 60)
+    if period > 0:
+        return 'every ' + format_duration(period)
+    result = 'every '
+    for name in day_masks:
+        if day_masks[name] == days:
+            result += name
+            break
+    else:
+        result += ', '.join([weekday_names[i] + 'day' for i in range(len(weekday_names)) if days & (1 << i)])
+    return result + ' at {0:02}:{1:02}'.format(time_of_day // 3600, time_of_day % 3600 // 60)
+
 def build_help_message(mention):
     result = mention + ' Create a reminder by using any message prefix with a specific reminder message and a specific time.'
     result += 'A reminder can be created without a message and a reminder can be created without a time (defaults to in 1 day).'
     result += '\nEx: \"remindme test in 2 hours\" will create a reminder in 2 hours with the reminder message \"test\".'
+    result += '\nReminders can repeat, ex: \"remindme standup every weekday at 9am\" or \"remindme stretch every 2 hours\".'
     result += '\nHere is a list of message prefixes the bot will respond: '
     for i in range(len(bot_prefixes)-1):
         result += '\"' + bot_prefixes[i] + '\", '
@@ -112,31 +407,79 @@ def build_reaction_options(options):
     result += '|'
     return result
 
-async def list_reminders(user):
-    result = user.mention + ' Here is a list of your active reminders:'
-    index = 0
-    if user in user_reminders:
-        if len(user_reminders[user]) > 0:
-            for reminder in user_reminders[user]:
-                index += 1
-                result += '\n{0} - \"{1}\" for {2} in this channel: '.format(index, reminder.info, reminder.reminder_time)
-                try:
-                    channel_name = client.get_channel(reminder.channel_id).name
-                except AttributeError:
-                    result += 'Bot DMs. '
-                else:
-                    result += '\"{0}\". '.format(channel_name)
-                # removed linking original message because long reminder lists would hang
-                # try:
-                #     message = await client.get_channel(reminder.channel_id).fetch_message(reminder.message_id)
-                # except discord.NotFound:
-                #     pass
-                # else:
-                #     result += 'Here is a link to the original message: {0}'.format(message.jump_url)
-    if index == 0:
-        result += '\nYou have no active reminders!'
+def build_confirmation(mention, reminder, zone):
+    result = '{0} A reminder has been created for \"{1}\" and has been set to go off at {2}'.format(mention, reminder.info, format_time(reminder.reminder_time, zone))
+    if reminder.recurrence != None:
+        result += ', repeating ' + format_recurrence(reminder.recurrence)
+    result += '.'
+    if zone == None:
+        result += ' Use \"{0} timezone <Timezone>\" to set your timezone.'.format(bot_prefixes[0])
+    result += '\nReact to this message with these reactions to perform these commands:\n{0}'.format(confirmation_reactions)
     return result
 
+# these never change, only build them once
+help_message_body = build_help_message('')
+confirmation_reactions = build_reaction_options(confirmation_options)
+
+# reacts in order so the options show up in order
+async def add_reactions(message, count, reactions=emojis):
+    for i in range(count):
+        await message.add_reaction(reactions[i])
+    return
+
+# pages of a user's reminder list, built once and kept until their reminders change
+def get_list_pages(user_id):
+    global list_cache
+    if user_id in list_cache:
+        list_cache.move_to_end(user_id)
+        return list_cache[user_id]
+    zone = user_timezone(user_id)
+    pages = []
+    page = []
+    length = 0
+    for index, reminder in enumerate(store.get_user_reminders(user_id), 1):
+        guild_id = reminder_guild_id(reminder)
+        line = '{0} - \"{1}\" for {2}'.format(index, reminder.info, format_time(reminder.reminder_time, zone))
+        if reminder.recurrence != None:
+            line += ', repeating ' + format_recurrence(reminder.recurrence)
+        line += ' in {0}. [Link]({1}) to the original message.'.format('<#{0}>'.format(reminder.channel_id) if guild_id != None else 'Bot DMs', jump_url(guild_id, reminder.channel_id, reminder.message_id))
+        # a page ends after list_page_size reminders or before it gets too long for an embed
+        if len(page) == list_page_size or length + len(line) + 1 > embed_length_limit:
+            pages.append('\n'.join(page))
+            page = []
+            length = 0
+        page.append(line)
+        length += len(line) + 1
+    if len(page) > 0:
+        pages.append('\n'.join(page))
+    list_cache[user_id] = pages
+    if len(list_cache) > list_cache_size:
+        list_cache.popitem(last=False)
+    return pages
+
+# called whenever a user's reminders are created, deleted, fired or shown differently
+def invalidate_list(user_id):
+    list_cache.pop(user_id, None)
+    return
+
+# returns the message content, the embed description and the number of pages
+def build_list_page(user_id, page):
+    pages = get_list_pages(user_id)
+    if len(pages) == 0:
+        return mention(user_id) + ' Here is a list of your active reminders:\nYou have no active reminders!', None, 0
+    page = max(0, min(page, len(pages) - 1))
+    result = mention(user_id) + ' Here is a list of your active reminders:'
+    if len(pages) > 1:
+        result += ' (Page {0} of {1}, react with {2} and {3} to change pages)'.format(page + 1, len(pages), list_emojis[0], list_emojis[1])
+    return result, pages[page], len(pages)
+
+def register_list_message(message_id, user_id, page):
+    global list_message_ids
+    list_message_ids[message_id] = (user_id, page)
+    if len(list_message_ids) > list_message_limit:
+        list_message_ids.popitem(last=False)
+    return
+
 ### I/O ###
 
 def setup_tokens(file_name):
@@ -146,164 +489,880 @@ def setup_tokens(file_name):
     tokens.close()
     return
 
-def save_reminders(output_file):
-    for reminder in reminder_tasks.keys():
-        reminder.save_reminder(output_file)
-    return
+# append only log of reminder events on top of a snapshot of every reminder
+# the snapshot is sorted by due time so it can be read a window at a time
+class ReminderJournal:
+    def __init__(self, journal_file, snapshot_file):
+        self.journal_file = journal_file
+        self.snapshot_file = snapshot_file
+        self.journal = None
+        # snapshot being read and the next reminder read from it
+        self.snapshot = None
+        self.next_reminder = None
+        # snapshots from older versions are not sorted and have to be read all at once
+        self.sorted = True
+        # reminders from such a snapshot, read before the journal so their new IDs are handed out first
+        self.legacy_reminders = []
+        # events written since the last fsync and since the last compaction
+        self.unsynced = 0
+        self.entries = 0
+        # user ID -> timezone name, loaded from the snapshot header and the journal
+        self.timezones = {}
+
+    # replays the journal, reminder ID -> Reminder or None if it was fired or cancelled
+    def load(self):
+        replayed = {}
+        if os.path.exists(self.snapshot_file):
+            self.snapshot = open(self.snapshot_file, 'rb')
+            header = self.read_frame()
+            if isinstance(header, Reminder):
+                # they have no saved IDs and are given the same ones on every load, as long as nothing else takes an ID first
+                self.sorted = False
+                self.next_reminder = header
+                self.legacy_reminders = self.read_snapshot(float('inf'))
+            elif header != None:
+                # reminders further in the snapshot are not loaded yet, their IDs cannot be reused
+                seen_reminder_id(header[1])
+                # headers written before timezones were stored only have the last ID
+                if len(header) > 2:
+                    self.timezones = header[2]
+        events, valid_length = self.read_frames(self.journal_file)
+        for event, payload in events:
+            # reminders created by one message are one frame, they are saved together or not at all
+            if event == 'create' and isinstance(payload, list):
+                for reminder in payload:
+                    replayed[reminder.reminder_id] = reminder
+            elif event == 'create' or event == 'update':
+                replayed[payload.reminder_id] = payload
+            elif event == 'timezone':
+                self.timezones[payload[0]] = payload[1]
+            else:
+                replayed[payload] = None
+            self.entries += 1
+        self.journal = open(self.journal_file, 'ab')
+        # drop a cut off last frame so new events are not appended after it
+        self.journal.truncate(valid_length)
+        return replayed
+
+    def read_frame(self):
+        try:
+            return pickle.load(self.snapshot)
+        # the last frame can be cut off by a crash
+        except (EOFError, pickle.UnpicklingError):
+            self.snapshot.close()
+            self.snapshot = None
+            return None
 
-async def load_reminders(input_file):
-    global user_reminders, reminder_tasks
-    reminders = []
-    if input_file in os.listdir(os.getcwd()):
-        with open(input_file, 'rb') as infile:
-            while True:
-                try:
-                    reminders.append(pickle.load(infile))
-                except EOFError:
+    # reads the next reminders in the snapshot that are due before until, up to limit of them
+    def read_snapshot(self, until, limit=None):
+        reminders = []
+        while self.snapshot != None and (limit == None or len(reminders) < limit):
+            if self.next_reminder == None:
+                self.next_reminder = self.read_frame()
+                if self.next_reminder == None:
                     break
-        infile.close()
-        os.remove(input_file)
-    for reminder in reminders:
-        user = client.get_user(reminder.user_id)
-        if user not in user_reminders:
-            user_reminders[user] = []
-        user_reminders[user].append(reminder)
-        reminder_tasks[reminder] = asyncio.create_task(run_reminder(reminder))
+            if self.sorted and self.next_reminder.reminder_time >= until:
+                break
+            reminders.append(self.next_reminder)
+            self.next_reminder = None
+        return reminders
+
+    def loading(self):
+        return self.snapshot != None
+
+    # returns the frames and the length of the file they were read from
+    def read_frames(self, file_name):
+        frames = []
+        valid_length = 0
+        if os.path.exists(file_name):
+            with open(file_name, 'rb') as infile:
+                while True:
+                    try:
+                        frames.append(pickle.load(infile))
+                    # the last frame can be cut off by a crash
+                    except (EOFError, pickle.UnpicklingError):
+                        break
+                    valid_length = infile.tell()
+        return frames, valid_length
+
+    # create takes a list of Reminders, update takes the Reminder, fire and cancel take its ID, timezone takes (user ID, timezone name)
+    def record(self, event, payload):
+        pickle.dump((event, payload), self.journal, pickle.HIGHEST_PROTOCOL)
+        self.unsynced += 1
+        self.entries += 1
+        return
+
+    # writes are batched, this runs every journal_flush_interval seconds
+    def flush(self):
+        if self.unsynced > 0:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+        return
+
+    # rewrites the snapshot from every live reminder, in due time order, and empties the journal
+    def compact(self, reminders, timezones):
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'wb') as outfile:
+            pickle.dump(('snapshot', last_reminder_id, timezones), outfile, pickle.HIGHEST_PROTOCOL)
+            for reminder in reminders:
+                pickle.dump(reminder, outfile, pickle.HIGHEST_PROTOCOL)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_file, self.snapshot_file)
+        self.journal.close()
+        self.journal = open(self.journal_file, 'wb')
+        self.unsynced = 0
+        self.entries = 0
+        self.sorted = True
+        self.legacy_reminders = []
+        return
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        if self.snapshot != None:
+            self.snapshot.close()
+        return
+
+# one user's reminders ordered by due time, with an index on their reminder messages
+class UserReminders:
+    def __init__(self):
+        # sorted (due timestamp, reminder ID) pairs
+        self.order = []
+        # reminder ID -> Reminder
+        self.reminders = {}
+        # reminder message -> set of reminder IDs
+        self.by_info = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, reminder):
+        bisect.insort(self.order, (reminder.reminder_time, reminder.reminder_id))
+        self.reminders[reminder.reminder_id] = reminder
+        if reminder.info not in self.by_info:
+            self.by_info[reminder.info] = set()
+        self.by_info[reminder.info].add(reminder.reminder_id)
+        return
+
+    def remove(self, reminder):
+        del self.order[bisect.bisect_left(self.order, (reminder.reminder_time, reminder.reminder_id))]
+        del self.reminders[reminder.reminder_id]
+        self.by_info[reminder.info].discard(reminder.reminder_id)
+        if len(self.by_info[reminder.info]) == 0:
+            del self.by_info[reminder.info]
+        return
+
+    def all(self):
+        return [self.reminders[reminder_id] for _, reminder_id in self.order]
+
+    # the first reminder due with this reminder message
+    def find(self, info):
+        if info not in self.by_info:
+            return None
+        return min([self.reminders[reminder_id] for reminder_id in self.by_info[info]], key=lambda reminder: (reminder.reminder_time, reminder.reminder_id))
+
+    # index in due time order
+    def at(self, index):
+        if 0 <= index < len(self.order):
+            return self.reminders[self.order[index][1]]
+        return None
+
+# every reminder in memory, persisted through a ReminderJournal
+# reminders due after the scheduled window are read from the snapshot in the background once the bot is ready
+class MemoryStore:
+    def __init__(self, journal_file, snapshot_file):
+        self.journal = ReminderJournal(journal_file, snapshot_file)
+        # reminder ID -> Reminder
+        self.reminders = {}
+        # user ID -> UserReminders
+        self.user_reminders = {}
+        # confirmation message ID -> Reminder
+        self.confirmations = {}
+        # sorted (due timestamp, reminder ID) pairs for paging reminders into the scheduler
+        self.due_index = []
+        # guild ID -> number of reminders made in that guild
+        self.guild_counts = {}
+        # journal events replayed over the snapshot, reminder ID -> Reminder or None
+        self.replayed = {}
+        # user ID -> timezone name, only for users that set one
+        self.timezones = {}
+
+    def load(self, until):
+        self.replayed = self.journal.load()
+        self.timezones = self.journal.timezones
+        for reminder in self.replayed.values():
+            if reminder != None:
+                self.insert(reminder)
+        # reminders from an older version keep their IDs only once they are in a new snapshot, so it is written right away
+        if not self.journal.sorted:
+            for reminder in self.journal.legacy_reminders:
+                if reminder.reminder_id not in self.replayed:
+                    self.insert(reminder)
+            self.compact()
+            return
+        self.load_until(until)
+        return
+
+    def load_until(self, until, limit=None):
+        reminders = self.journal.read_snapshot(until, limit)
+        for reminder in reminders:
+            # the journal has a newer version of the reminder or it is gone
+            if reminder.reminder_id not in self.replayed:
+                self.insert(reminder)
+        return len(reminders)
+
+    def loading(self):
+        return self.journal.loading()
+
+    def insert(self, reminder):
+        self.reminders[reminder.reminder_id] = reminder
+        if reminder.user_id not in self.user_reminders:
+            self.user_reminders[reminder.user_id] = UserReminders()
+        self.user_reminders[reminder.user_id].add(reminder)
+        if reminder.confirmation_id != None:
+            self.confirmations[reminder.confirmation_id] = reminder
+        bisect.insort(self.due_index, (reminder.reminder_time, reminder.reminder_id))
+        self.count_guild_reminder(reminder, 1)
+        return
+
+    def count_guild_reminder(self, reminder, change):
+        if reminder.guild_id == None:
+            return
+        self.guild_counts[reminder.guild_id] = self.guild_counts.get(reminder.guild_id, 0) + change
+        if self.guild_counts[reminder.guild_id] == 0:
+            del self.guild_counts[reminder.guild_id]
+        return
+
+    def add(self, reminders):
+        for reminder in reminders:
+            self.insert(reminder)
+        self.journal.record('create', reminders)
+        return
+
+    # for changes that do not move the reminder's time
+    def update(self, reminder):
+        # it already fired or was cancelled
+        if reminder.reminder_id not in self.reminders:
+            return
+        if reminder.confirmation_id != None:
+            self.confirmations[reminder.confirmation_id] = reminder
+        self.journal.record('update', reminder)
+        return
+
+    # moves a recurring reminder to its next occurrence, False if it is no longer stored
+    def reschedule(self, reminder, reminder_time):
+        reminder = self.reminders.get(reminder.reminder_id)
+        if reminder == None:
+            return False
+        self.user_reminders[reminder.user_id].remove(reminder)
+        del self.due_index[bisect.bisect_left(self.due_index, (reminder.reminder_time, reminder.reminder_id))]
+        reminder.reminder_time = reminder_time
+        self.user_reminders[reminder.user_id].add(reminder)
+        bisect.insort(self.due_index, (reminder.reminder_time, reminder.reminder_id))
+        self.journal.record('update', reminder)
+        return True
+
+    # event is 'fire' or 'cancel'
+    def remove(self, reminder, event):
+        reminder = self.reminders.pop(reminder.reminder_id, None)
+        if reminder == None:
+            return
+        user_reminders = self.user_reminders[reminder.user_id]
+        user_reminders.remove(reminder)
+        if len(user_reminders) == 0:
+            del self.user_reminders[reminder.user_id]
+        self.confirmations.pop(reminder.confirmation_id, None)
+        del self.due_index[bisect.bisect_left(self.due_index, (reminder.reminder_time, reminder.reminder_id))]
+        self.count_guild_reminder(reminder, -1)
+        self.journal.record(event, reminder.reminder_id)
+        return
+
+    # cancels every reminder of a user in one pass, returns them
+    def remove_user_reminders(self, user_id):
+        if user_id not in self.user_reminders:
+            return []
+        reminders = self.user_reminders.pop(user_id).all()
+        for reminder in reminders:
+            del self.reminders[reminder.reminder_id]
+            self.confirmations.pop(reminder.confirmation_id, None)
+            del self.due_index[bisect.bisect_left(self.due_index, (reminder.reminder_time, reminder.reminder_id))]
+            self.count_guild_reminder(reminder, -1)
+            self.journal.record('cancel', reminder.reminder_id)
+        return reminders
+
+    # in due time order
+    def get_user_reminders(self, user_id):
+        if user_id not in self.user_reminders:
+            return []
+        return self.user_reminders[user_id].all()
+
+    def count_user_reminders(self, user_id):
+        if user_id not in self.user_reminders:
+            return 0
+        return len(self.user_reminders[user_id])
+
+    def count_guild_reminders(self, guild_id):
+        return self.guild_counts.get(guild_id, 0)
+
+    def find_user_reminder(self, user_id, info):
+        if user_id not in self.user_reminders:
+            return None
+        return self.user_reminders[user_id].find(info)
+
+    # index is into the user's reminders in due time order
+    def get_user_reminder(self, user_id, index):
+        if user_id not in self.user_reminders:
+            return None
+        return self.user_reminders[user_id].at(index)
+
+    def get_by_confirmation(self, confirmation_id):
+        return self.confirmations.get(confirmation_id)
+
+    def get_timezone(self, user_id):
+        return self.timezones.get(user_id)
+
+    def set_timezone(self, user_id, name):
+        self.timezones[user_id] = name
+        self.journal.record('timezone', (user_id, name))
+        return
+
+    # reminders due at or after start and before end
+    def due_between(self, start, end):
+        self.load_until(end)
+        first = bisect.bisect_left(self.due_index, (start,))
+        last = bisect.bisect_left(self.due_index, (end,))
+        return [self.reminders[reminder_id] for _, reminder_id in self.due_index[first:last]]
+
+    def flush(self):
+        self.journal.flush()
+        return
+
+    def compact(self):
+        # the snapshot being replaced has to be read completely first
+        self.load_until(float('inf'))
+        self.journal.compact((self.reminders[reminder_id] for _, reminder_id in self.due_index), self.timezones)
+        self.replayed = {}
+        return
+
+    def close(self):
+        self.journal.close()
+        return
+
+# reminders kept in a local sqlite database, only the scheduled window is held in memory
+class DatabaseStore:
+    def __init__(self, database_file):
+        self.connection = sqlite3.connect(database_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS reminders (reminder_id INTEGER PRIMARY KEY)')
+        # one column per Reminder attribute, added when a newer version introduces one
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(reminders)')]
+        for column in Reminder.__slots__:
+            if column not in existing:
+                self.connection.execute('ALTER TABLE reminders ADD COLUMN {0}'.format(column))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reminders_due ON reminders (reminder_time)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reminders_user_due ON reminders (user_id, reminder_time)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reminders_user_info ON reminders (user_id, info)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reminders_guild ON reminders (guild_id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reminders_confirmation ON reminders (confirmation_id)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS timezones (user_id INTEGER PRIMARY KEY, timezone)')
+        self.connection.commit()
+        # only users that set a timezone are in the table, it is small enough to keep in memory
+        self.timezones = dict(self.connection.execute('SELECT user_id, timezone FROM timezones'))
+        self.select = 'SELECT ' + ', '.join(Reminder.__slots__) + ' FROM reminders '
+        self.recurrence_column = Reminder.__slots__.index('recurrence')
+
+    # reminders are read from the database when the scheduler pages them in
+    def load(self, until):
+        last_id = self.connection.execute('SELECT MAX(reminder_id) FROM reminders').fetchone()[0]
+        if last_id != None:
+            seen_reminder_id(last_id)
+        return
+
+    def load_until(self, until, limit=None):
+        return 0
+
+    def loading(self):
+        return False
+
+    def to_reminder(self, row):
+        reminder = Reminder.__new__(Reminder)
+        for key, value in zip(Reminder.__slots__, row):
+            setattr(reminder, key, value)
+        if reminder.recurrence != None:
+            reminder.recurrence = tuple(int(part) for part in reminder.recurrence.split(','))
+        return reminder
+
+    # sqlite has no tuples, recurrence rules are stored as text
+    def to_row(self, reminder):
+        row = [getattr(reminder, key) for key in Reminder.__slots__]
+        if reminder.recurrence != None:
+            row[self.recurrence_column] = ','.join(map(str, reminder.recurrence))
+        return row
+
+    # nothing is committed between the inserts, so the reminders are saved together or not at all
+    def add(self, reminders):
+        self.connection.executemany('INSERT OR REPLACE INTO reminders (' + ', '.join(Reminder.__slots__) + ') VALUES (' + ', '.join('?' * len(Reminder.__slots__)) + ')',
+                                    [self.to_row(reminder) for reminder in reminders])
+        return
+
+    # does nothing if the reminder already fired or was cancelled
+    def update(self, reminder):
+        self.connection.execute('UPDATE reminders SET ' + ', '.join([column + ' = ?' for column in Reminder.__slots__]) + ' WHERE reminder_id = ?',
+                                self.to_row(reminder) + [reminder.reminder_id])
+        return
+
+    def reschedule(self, reminder, reminder_time):
+        reminder.reminder_time = reminder_time
+        return self.connection.execute('UPDATE reminders SET reminder_time = ? WHERE reminder_id = ?', (reminder_time, reminder.reminder_id)).rowcount > 0
+
+    def remove(self, reminder, event):
+        self.connection.execute('DELETE FROM reminders WHERE reminder_id = ?', (reminder.reminder_id,))
+        return
+
+    def remove_user_reminders(self, user_id):
+        reminders = self.get_user_reminders(user_id)
+        self.connection.execute('DELETE FROM reminders WHERE user_id = ?', (user_id,))
+        return reminders
+
+    def get_user_reminders(self, user_id):
+        rows = self.connection.execute(self.select + 'WHERE user_id = ? ORDER BY reminder_time, reminder_id', (user_id,))
+        return [self.to_reminder(row) for row in rows]
+
+    def count_user_reminders(self, user_id):
+        return self.connection.execute('SELECT COUNT(*) FROM reminders WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def count_guild_reminders(self, guild_id):
+        return self.connection.execute('SELECT COUNT(*) FROM reminders WHERE guild_id = ?', (guild_id,)).fetchone()[0]
+
+    def find_user_reminder(self, user_id, info):
+        row = self.connection.execute(self.select + 'WHERE user_id = ? AND info = ? ORDER BY reminder_time, reminder_id LIMIT 1', (user_id, info)).fetchone()
+        if row == None:
+            return None
+        return self.to_reminder(row)
+
+    def get_user_reminder(self, user_id, index):
+        if index < 0:
+            return None
+        row = self.connection.execute(self.select + 'WHERE user_id = ? ORDER BY reminder_time, reminder_id LIMIT 1 OFFSET ?', (user_id, index)).fetchone()
+        if row == None:
+            return None
+        return self.to_reminder(row)
+
+    def get_by_confirmation(self, confirmation_id):
+        row = self.connection.execute(self.select + 'WHERE confirmation_id = ?', (confirmation_id,)).fetchone()
+        if row == None:
+            return None
+        return self.to_reminder(row)
+
+    def get_timezone(self, user_id):
+        return self.timezones.get(user_id)
+
+    def set_timezone(self, user_id, name):
+        self.timezones[user_id] = name
+        self.connection.execute('INSERT OR REPLACE INTO timezones (user_id, timezone) VALUES (?, ?)', (user_id, name))
+        return
+
+    def due_between(self, start, end):
+        rows = self.connection.execute(self.select + 'WHERE reminder_time >= ? AND reminder_time < ? ORDER BY reminder_time', (start, end))
+        return [self.to_reminder(row) for row in rows]
+
+    # commits are batched the same way the journal's fsyncs are
+    def flush(self):
+        self.connection.commit()
+        return
+
+    def compact(self):
+        self.connection.commit()
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        return
+
+# each shard keeps its own files, ex: saved_reminders.shard0.pkl
+def shard_file(file_name):
+    if shard_count <= 1:
+        return file_name
+    name, extension = os.path.splitext(file_name)
+    return '{0}.shard{1}{2}'.format(name, shard_id, extension)
+
+def open_store():
+    if storage_backend == 'sqlite':
+        return DatabaseStore(shard_file(database_file))
+    return MemoryStore(shard_file(journal_file), shard_file(save_file))
+
+def save_reminders():
+    store.compact()
+    return
+
+async def load_reminders():
+    start = time.time()
+    # only reminders due inside the scheduler's window are needed to be ready
+    store.load(start + schedule_window)
+    page_in_reminders(start)
+    print('Loaded reminders due in the next {0} hours in {1:.3f} seconds.'.format(schedule_window / 3600, time.time() - start))
+    return
+
+# reads the rest of the saved reminders in small batches so the bot stays responsive
+async def stream_reminders():
+    start = time.time()
+    count = 0
+    while store.loading():
+        count += store.load_until(float('inf'), stream_batch_size)
+        await asyncio.sleep(0)
+    if count > 0:
+        print('Loaded {0} later reminders in {1:.3f} seconds.'.format(count, time.time() - start))
+        # lists made before now could be missing these reminders
+        list_cache.clear()
     return
 
+async def run_storage():
+    last_compaction = time.time()
+    while True:
+        await asyncio.sleep(journal_flush_interval)
+        store.flush()
+        if time.time() - last_compaction > compaction_interval or (storage_backend == 'journal' and store.journal.entries > compaction_entries):
+            save_reminders()
+            last_compaction = time.time()
+
 ### DISCORD ###
 
 # the discord client
 help_activity = discord.Activity(name='\"' + bot_prefixes[0] + ' help\" for help',type=discord.ActivityType.playing)
-client = discord.Client(activity=help_activity)
+if shard_count > 1:
+    client = discord.AutoShardedClient(activity=help_activity, shard_ids=[shard_id], shard_count=shard_count)
+else:
+    client = discord.Client(activity=help_activity)
 
 @client.event
 async def on_ready():
-    print('Loading in saved reminders:')
-    await load_reminders(save_file)
+    global scheduler_wakeup, scheduler_task, storage_task, store, accepting_messages
+    # on_ready also fires after reconnects, only ever load and start the scheduler once
+    if scheduler_task == None:
+        scheduler_wakeup = asyncio.Event()
+        if '--handoff' in sys.argv:
+            print('Waiting for the old process to hand over its reminders:')
+            await receive_handoff()
+            store = open_store()
+        print('Loading in saved reminders:')
+        await load_reminders()
+        scheduler_task = asyncio.create_task(run_scheduler())
+        storage_task = asyncio.create_task(run_storage())
+        asyncio.create_task(stream_reminders())
+        asyncio.create_task(run_metrics())
+        accepting_messages = True
+        print('Done. The bot is ready to go! Time to ready: {0:.3f} seconds.'.format(time.time() - start_time))
+        return
     print('Done. The bot is ready to go!')
     return
 
 @client.event
 async def on_message(message):
-    for prefix in bot_prefixes:
-        if message.content.lower().startswith(prefix):
-            _, _, removed_prefix = message.content.lower().partition(' ')
-            parameters = removed_prefix.split()
-            if len(parameters) > 0:
-                if len(parameters) == 1:
-                    if parameters[0] == 'help':
-                        await message.channel.send(build_help_message(message.author.mention))
-                        return
-                    elif parameters[0] == 'list':
-                        await message.channel.send(await list_reminders(message.author))
-                        return
-                    elif parameters[0] == 'clear':
-                        asyncio.create_task(clear_messages(message))
-                        return
-                    elif parameters[0] == 'restart':
-                        await restart(message)
-                        return
-                elif parameters[0] == 'delete':
-                    if message.author in user_reminders:
-                        if len(parameters) == 2 and parameters[1] == 'all':
-                            if len(user_reminders[message.author]) > 0:
-                                for reminder in user_reminders[message.author]:
-                                    asyncio.create_task(cancel_reminder(reminder))
-                                return
-                        else:
-                            reminder = get_reminder(message.author, removed_prefix.replace('delete','',1).strip())
-                            if reminder != None:
-                                asyncio.create_task(cancel_reminder(reminder))
-                                return
-            asyncio.create_task(create_reminders(message))
+    # the bot's own messages never need a response
+    if message.author.id == client.user.id or not accepting_messages:
+        return
+    if prefix_pattern.match(message.content) == None:
+        return
+    removed_prefix = remove_prefix(message.content).lower()
+    parameters = removed_prefix.split()
+    if len(parameters) > 0 and parameters[0] in command_handlers:
+        if await command_handlers[parameters[0]](message, parameters, removed_prefix):
             return
-        if message.author.id == client.user.id:
-            if message.content.endswith(build_reaction_options(confirmation_options)):
-                for i in range(len(confirmation_options)):
-                    asyncio.create_task(message.add_reaction(emojis[i]))
-            elif message.content.endswith(build_help_message('')):
-                for i in range(len(commands)):
-                    asyncio.create_task(message.add_reaction(emojis[i]))
+    # turned away before parsing so an overloaded bot does not take on more
+    reason = admission_check()
+    if reason != None:
+        reminders_rejected.inc()
+        notify_rejection(message, reason)
+        return
+    task = asyncio.create_task(create_reminders(message))
+    creation_tasks.add(task)
+    task.add_done_callback(creation_tasks.discard)
+    return
+
+# the owner of a list message turns its page with ◀️ and ▶️
+# adding or removing the reaction both count, bots cannot remove reactions in DMs
+async def turn_list_page(payload):
+    entry = list_message_ids.get(payload.message_id)
+    if entry == None or entry[0] != payload.user_id:
+        return
+    user_id, page = entry
+    page += 1 if payload.emoji.name == list_emojis[1] else -1
+    content, description, pages = build_list_page(user_id, page)
+    page = max(0, min(page, pages - 1))
+    if page == entry[1] and pages > 1:
+        return
+    list_message_ids[payload.message_id] = (user_id, page)
+    await dispatcher.edit(payload.channel_id, payload.message_id, content, description)
+    return
+
+@client.event
+async def on_raw_reaction_remove(payload):
+    if payload.emoji.name in list_emojis and accepting_messages:
+        await turn_list_page(payload)
     return
 
 @client.event
 async def on_raw_reaction_add(payload):
-    if payload.emoji.name in emojis:
-        channel = client.get_channel(payload.channel_id)
-        this_message = await channel.fetch_message(payload.message_id)
-        if this_message.author.id == client.user.id and client.user.id != payload.user_id:
-            option = emojis.index(payload.emoji.name)
-            user = client.get_user(payload.user_id)
-            # confirmation options
-            if this_message.content.endswith(build_reaction_options(confirmation_options)):
-                if this_message.content[:this_message.content.find(' ')].replace('!','') == user.mention:
-                    for reminder in user_reminders[user]:
-                        try:
-                            confirmation = await channel.fetch_message(reminder.confirmation_id)
-                        except discord.NotFound:
-                            continue
-                        else:
-                            if confirmation.content == this_message.content:
-                                if option == 0:
-                                    asyncio.create_task(cancel_reminder(reminder))
-                                    return
-                                if option == 1 or option == 3:
-                                    await this_message.delete()
-                                if option == 2 or option == 3:
-                                    try:
-                                        trigger_message = await channel.fetch_message(reminder.message_id)
-                                    except discord.NotFound:
-                                        pass
-                                    else:
-                                        await trigger_message.delete()
-                            return
-            # help message
-            elif this_message.content.endswith(build_help_message('')):
-                await channel.send(user.mention + help_messages[emojis.index(payload.emoji.name)])
-                return
-    return
-
-async def clear_messages(message):
-    deleted = asyncio.create_task(message.channel.purge(limit=500, check=clear_conditions))
-    while True:
-        try:
-            deleted.result()
-        except asyncio.base_futures.InvalidStateError:
-            await asyncio.sleep(0.1)
-        else:
-            break
+    if payload.emoji.name in list_emojis and payload.user_id != client.user.id and accepting_messages:
+        await turn_list_page(payload)
+        return
+    # reactions on messages that are not a help message or a confirmation are dropped without any requests
+    if payload.emoji.name not in emojis or payload.user_id == client.user.id or not accepting_messages:
+        return
+    option = emojis.index(payload.emoji.name)
+    # help message
+    if payload.message_id in help_message_ids:
+        if option < len(help_messages):
+            await dispatcher.send(payload.channel_id, mention(payload.user_id) + help_messages[option])
+        return
+    # confirmation options, only for the user that created the reminder
+    reminder = store.get_by_confirmation(payload.message_id)
+    if reminder == None or reminder.user_id != payload.user_id:
+        return
+    if option == 0:
+        asyncio.create_task(cancel_reminder(reminder))
+        return
+    if option == 1 or option == 3:
+        await dispatcher.delete(payload.channel_id, payload.message_id)
+    if option == 2 or option == 3:
+        await dispatcher.delete(payload.channel_id, reminder.message_id)
+    return
+
+# after is a timestamp, only messages sent after it are checked
+async def clear_messages(message, limit=clear_limit, after=None):
+    start = time.time()
+    if not hasattr(message.channel, 'purge'):
+        await dispatcher.send(message.channel.id, message.author.mention + ' Messages can only be cleared in server channels.')
+        return
+    if after != None:
+        after = datetime.fromtimestamp(after, tz=timezone.utc).replace(tzinfo=None)
+    # purge bulk deletes up to 100 messages at a time and deletes messages older than 14 days one by one
+    deleted = await message.channel.purge(limit=limit, check=clear_conditions, after=after, bulk=True)
+    result = message.author.mention + ' Deleted {0} messages in {1:.2f} seconds.'.format(len(deleted), time.time() - start)
+    await dispatcher.send(message.channel.id, result)
+    return
 
 def clear_conditions(message):
     if message.author.id == client.user.id:
         return True
-    for prefix in bot_prefixes:
-        if message.content.startswith(prefix):
-            return True
-    return False
+    return prefix_pattern.match(message.content) != None
 
 async def restart(message):
-    save_reminders(save_file)
-    await message.channel.send(message.author.mention + ' Restarting the bot!')
-    os.system('sh restart.sh')
+    global exit_code
+    await dispatcher.send(message.channel.id, message.author.mention + ' Restarting the bot!')
+    # the supervisor updates and restarts shards, running tasks finish first so no reminder is saved half done or fired twice
+    if shard_count > 1:
+        await drain_tasks()
+        save_reminders()
+        store.close()
+        exit_code = restart_exit_code
+        await client.close()
+        return
+    # this process keeps running until the new one is connected and asks for the reminders
+    if os.path.exists(handoff_socket):
+        os.remove(handoff_socket)
+    await asyncio.start_unix_server(send_handoff, path=handoff_socket)
+    # in its own session so it outlives this process
+    subprocess.Popen(['sh', 'restart.sh', '--handoff'], start_new_session=True)
     return
 
+### HANDOFF ###
+
+# reminders being created or fired finish here so each one is saved or fired exactly once
+# messages and reactions are still answered while waiting, so they are only left to the new process for the save
+async def drain_tasks():
+    global accepting_messages
+    scheduler_task.cancel()
+    storage_task.cancel()
+    deadline = time.time() + handoff_drain_timeout
+    while len(creation_tasks | firing_tasks) > 0 and time.time() < deadline:
+        await asyncio.wait(creation_tasks | firing_tasks, timeout=deadline - time.time())
+    # from here on the new process answers messages
+    accepting_messages = False
+    # tasks still running are cancelled before the store closes, reminders they did not finish are fired again by the new process
+    pending = creation_tasks | firing_tasks
+    if len(pending) > 0:
+        print('Cancelling ' + str(len(pending)) + ' tasks that did not finish before the handoff.')
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+    return
+
+# runs in the old process when the new one connects to handoff_socket
+async def send_handoff(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readline(), handoff_timeout)
+    except asyncio.TimeoutError:
+        writer.close()
+        return
+    await drain_tasks()
+    save_reminders()
+    store.close()
+    writer.write(b'done\n')
+    await writer.drain()
+    writer.close()
+    os.remove(handoff_socket)
+    print('Handed off to the new process.')
+    await client.close()
+    return
+
+# runs in the new process once it is connected, returns when the old process has saved and closed the store
+async def receive_handoff():
+    try:
+        reader, writer = await asyncio.open_unix_connection(handoff_socket)
+        writer.write(b'ready\n')
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), handoff_drain_timeout + handoff_timeout)
+        writer.close()
+        # the old process exited without saying it was done, it may not have saved everything
+        if line != b'done\n':
+            print('The old process closed the connection during the handoff, loading the saved reminders.')
+    except (OSError, asyncio.TimeoutError):
+        print('The old process did not hand off, loading the saved reminders.')
+    return
+
+# command handlers return False if the message is not a valid use of the command, then it is treated as a new reminder
+
+async def help_command(message, parameters, removed_prefix):
+    if len(parameters) != 1:
+        return False
+    help_message = await dispatcher.send(message.channel.id, message.author.mention + help_message_body)
+    register_help_message(help_message.id)
+    asyncio.create_task(add_reactions(help_message, len(commands)))
+    return True
+
+async def list_command(message, parameters, removed_prefix):
+    if len(parameters) != 1:
+        return False
+    content, description, pages = build_list_page(message.author.id, 0)
+    list_message = await dispatcher.send(message.channel.id, content, description)
+    if pages > 1:
+        register_list_message(list_message.id, message.author.id, 0)
+        asyncio.create_task(add_reactions(list_message, len(list_emojis), list_emojis))
+    return True
+
+async def restart_command(message, parameters, removed_prefix):
+    if len(parameters) != 1:
+        return False
+    await restart(message)
+    return True
+
+# "clear", "clear <number of messages>" or "clear <time range>", ex: "clear 2 hours"
+async def clear_command(message, parameters, removed_prefix):
+    argument = ' '.join(parameters[1:])
+    if len(parameters) == 1:
+        asyncio.create_task(clear_messages(message))
+    elif argument.isdigit():
+        asyncio.create_task(clear_messages(message, limit=int(argument)))
+    elif relative_time_pattern.match(argument) != None:
+        asyncio.create_task(clear_messages(message, limit=None, after=time.time() - parse_duration(argument)))
+    else:
+        return False
+    return True
+
+async def delete_command(message, parameters, removed_prefix):
+    if len(parameters) == 1:
+        return False
+    if len(parameters) == 2 and parameters[1] == 'all':
+        if store.count_user_reminders(message.author.id) > 0:
+            asyncio.create_task(cancel_all_reminders(message.author.id, message.channel.id))
+            return True
+    else:
+        reminder = get_reminder(message.author.id, removed_prefix.replace('delete','',1).strip())
+        if reminder != None:
+            asyncio.create_task(cancel_reminder(reminder))
+            return True
+    return False
+
+# "timezone" or "timezone <name>", ex: "timezone america/new_york"
+async def timezone_command(message, parameters, removed_prefix):
+    if len(parameters) == 1:
+        name = store.get_timezone(message.author.id)
+        if name == None:
+            result = ' You have not set a timezone, your reminders use {0}.'.format(default_timezone if default_timezone != None else 'the bot\'s timezone ({0})'.format(time.tzname[0]))
+        else:
+            result = ' Your timezone is {0}.'.format(name)
+    elif len(parameters) == 2 and parameters[1] in timezone_names:
+        name = timezone_names[parameters[1]]
+        store.set_timezone(message.author.id, name)
+        invalidate_list(message.author.id)
+        result = ' Your timezone has been set to {0}. It is currently {1}.'.format(name, format_time(time.time(), pytz.timezone(name)))
+    else:
+        return False
+    await dispatcher.send(message.channel.id, message.author.mention + result)
+    return True
+
+# command -> handler
+command_handlers = {'clear' : clear_command, 'delete' : delete_command, 'help' : help_command, 'list' : list_command, 'restart' : restart_command, 'timezone' : timezone_command}
+
 ### REMINDER INTERACTION ###
 
-def parse_message(message_content, reminder_messages, extracted_times):
+# dateparser is only imported by the parser processes, the bot process never loads it
+def warm_parser():
+    from dateparser.search import search_dates
+    # load dateparser's language data before the first real message arrives
+    search_dates('remind me in 1 hour', settings=parser_settings)
+    return
+
+def start_parser_pool():
+    global parser_slots
+    parser_slots = asyncio.Semaphore(parser_queue_limit)
+    create_parser_pool()
+    return
+
+def create_parser_pool():
+    global parser_pool
+    parser_pool = concurrent.futures.ProcessPoolExecutor(max_workers=parser_workers, initializer=warm_parser)
+    # start every worker now instead of on the first message, the initializer warms each one
+    for _ in range(parser_workers):
+        parser_pool.submit(int)
+    return
+
+# a pool cannot be used again once one of its workers died, like from being killed for using too much memory
+def replace_parser_pool(broken_pool):
+    # messages that failed on the same pool at once only replace it once
+    if parser_pool is not broken_pool:
+        return
+    print('A parser process died, starting new parser processes.')
+    broken_pool.shutdown(wait=False)
+    create_parser_pool()
+    return
+
+def remove_prefix(message_content):
     # remove prefix from content and remove first space
     _, _, removed_prefix = message_content.partition(' ')
-    removed_prefix.strip()
+    return removed_prefix
+
+def remove_mentions(content):
     # remove mentions by user ID because it messes with parsing
-    removed_prefix_mentions = re.sub('<@!?\\d+>', '', removed_prefix)
+    return re.sub('<@!?\\d+>', '', content)
+
+# now is a UTC timestamp, times are parsed as wall clock times in the timezone with this name, None is the host's local time
+def parse_message(removed_prefix, now, zone_name=None):
+    from dateparser.search import search_dates
+    reminder_messages = []
+    offsets = []
+    relative = True
+    zone = pytz.timezone(zone_name) if zone_name != None else None
     # extract times from removed_prefix
-    searched_times = search_dates(removed_prefix_mentions, settings={'PREFER_DATES_FROM' : 'future', 'PREFER_DAY_OF_MONTH' : 'first'})
+    settings = dict(parser_settings)
+    settings['RELATIVE_BASE'] = local_datetime(now, zone)
+    if zone_name != None:
+        settings['TIMEZONE'] = zone_name
+    searched_times = search_dates(remove_mentions(removed_prefix), settings=settings)
     if searched_times != None:
         # add extracted time strings to delimiters list
         delimiters = []
         for i in range(len(searched_times)):
             delimiters.append(searched_times[i][0])
-            extracted_times.append(searched_times[i][1])
+            offsets.append(local_timestamp(searched_times[i][1], zone) - now)
+            if relative_time_pattern.match(searched_times[i][0].strip()) == None:
+                relative = False
         # create regex pattern of time strings from delimiters list
         regex_pattern = '|'.join(map(re.escape, delimiters))
         # split message from the first space (to exclude the prefix) by regex pattern
@@ -313,118 +1372,798 @@ def parse_message(message_content, reminder_messages, extracted_times):
     else:
         # weird bug where if searched_times == () -> wouldn't execute loop below
         reminder_messages.append(removed_prefix)
+    return reminder_messages, offsets, relative
+
+def fast_parse(removed_prefix):
+    matches = list(fast_time_pattern.finditer(removed_prefix))
+    if len(matches) != 1:
+        return None
+    match = matches[0]
+    reminder_messages = [removed_prefix[:match.start()], removed_prefix[match.end():]]
+    # anything time related left over needs the full parser
+    if date_words_pattern.search(remove_mentions(''.join(reminder_messages))) != None:
+        return None
+    if match.group(1) == None:
+        offset = unit_seconds['d']
+    elif match.group(1).isdigit():
+        offset = int(match.group(1)) * unit_seconds[match.group(2)[0].lower()]
+    else:
+        offset = unit_seconds[match.group(2)[0].lower()]
+    return reminder_messages, [offset]
+
+# seconds in a time made of fixed length units, ex: "2 hours and 30 minutes"
+def parse_duration(text):
+    seconds = 0
+    for amount, unit in duration_pattern.findall(text):
+        seconds += (int(amount) if amount.isdigit() else 1) * unit_seconds[unit[0].lower()]
+    return seconds
+
+# a recurring reminder's message and rule, None if the message does not repeat
+def parse_recurrence(removed_prefix, now, zone):
+    match = recurrence_pattern.search(removed_prefix)
+    if match == None:
+        return None
+    days, amount, unit, named_time, hour, minute, meridiem = match.groups()
+    info = (removed_prefix[:match.start()] + ' ' + removed_prefix[match.end():]).strip()
+    timed = named_time != None or hour != None
+    # defaults to the time of day the reminder was created
+    local = local_datetime(now, zone)
+    time_of_day = local.hour * 3600 + local.minute * 60
+    if named_time != None:
+        time_of_day = 12 * 3600 if named_time.lower() == 'noon' else 0
+    elif hour != None:
+        hours = int(hour)
+        if meridiem != None:
+            hours = hours % 12 + (12 if meridiem.lower() == 'pm' else 0)
+        time_of_day = hours * 3600 + (int(minute) if minute != None else 0) * 60
+    if time_of_day >= 86400:
+        return None
+    if unit != None:
+        count = 1
+        if amount != None and amount.isdigit():
+            count = int(amount)
+        elif amount != None and amount.lower() == 'other':
+            count = 2
+        period = max(count * unit_seconds[unit[0].lower()], recurrence_min_period)
+        # every few days or weeks keeps its time of day across daylight saving changes, the day mask marks the rule as aligned to time_of_day
+        if unit[0].lower() in 'dw':
+            return info, (period, day_masks['day'], time_of_day)
+        # "every 2 hours at 9am" has no sensible meaning, it is left to the normal parser so the user sees how it was read
+        if timed:
+            return None
+        return info, (period, 0, 0)
+    days = days.lower()
+    mask = day_masks.get(days, 0)
+    for i in range(len(weekday_names)):
+        if weekday_names[i] + 'day' in days:
+            mask |= 1 << i
+    return info, (0, mask, time_of_day)
+
+def lookup_parse(removed_prefix):
+    global parse_cache
+    result = fast_parse(removed_prefix)
+    if result != None:
+        parse_stats['fast'] += 1
+        return result
+    key = ' '.join(removed_prefix.split())
+    if key in parse_cache:
+        parse_stats['hits'] += 1
+        parse_cache.move_to_end(key)
+        return parse_cache[key]
+    parse_stats['misses'] += 1
+    return None
+
+def cache_parse(removed_prefix, reminder_messages, offsets):
+    global parse_cache
+    parse_cache[' '.join(removed_prefix.split())] = (reminder_messages, offsets)
+    if len(parse_cache) > parse_cache_size:
+        parse_cache.popitem(last=False)
     return
 
+async def parse_in_pool(removed_prefix, now, zone):
+    # waits here when too many messages are already queued for the parsers
+    async with parser_slots:
+        # retried once on a new pool if a worker died, raises BrokenProcessPool if that fails too
+        for attempt in range(2):
+            pool = parser_pool
+            try:
+                return await asyncio.get_event_loop().run_in_executor(pool, parse_message, removed_prefix, now, zone.zone if zone != None else None)
+            except BrokenProcessPool:
+                if attempt == 1:
+                    raise
+                replace_parser_pool(pool)
+
+async def parse_times(message_content, zone):
+    removed_prefix = remove_prefix(message_content)
+    now = time.time()
+    # recurring reminders are parsed into a rule once, later occurrences are computed from it
+    recurring = parse_recurrence(removed_prefix, now, zone)
+    if recurring != None:
+        info, rule = recurring
+        return [info], [next_occurrence(rule, now, now, zone)], [rule]
+    # relative times are the same offset in every timezone, so cached parses are shared between timezones
+    result = lookup_parse(removed_prefix)
+    if result == None:
+        reminder_messages, offsets, relative = await parse_in_pool(removed_prefix, now, zone)
+        if relative:
+            cache_parse(removed_prefix, reminder_messages, offsets)
+    else:
+        reminder_messages, offsets = result
+    return reminder_messages, [now + offset for offset in offsets], [None] * len(offsets)
+
 async def create_reminders(message):
-    global reminder_tasks, user_reminders
-    reminder_messages = manager.list()
-    extracted_times = manager.list()
-    parsing_task = multiprocessing.Process(target=parse_message, args=(message.content, reminder_messages, extracted_times))
-    parsing_task.start()
-    while parsing_task.is_alive():
-        await asyncio.sleep(1)
+    zone = user_timezone(message.author.id)
+    parse_start = time.perf_counter()
+    try:
+        reminder_messages, extracted_times, recurrences = await parse_times(message.content, zone)
+    except BrokenProcessPool:
+        await dispatcher.send(message.channel.id, message.author.mention + ' The bot could not read the time in your reminder right now, so it was not created. Please try again in a few minutes.')
+        return
+    parse_seconds.observe(time.perf_counter() - parse_start)
     # strip each message of leading and trailing whitespace
     reminder_messages = [reminder_message.strip() for reminder_message in reminder_messages if reminder_message]
+    # build and check every reminder first, either all of them are created or none are
+    new_reminders = []
     for i in range(max(len(extracted_times),len(reminder_messages))):
-        new_reminder = Reminder(message.author.id,message.id,message.channel.id,message.created_at.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime("%H:%M:%S on %b %d, %Y"))
+        new_reminder = Reminder(message.author.id,message.id,message.channel.id,message.created_at.replace(tzinfo=timezone.utc).timestamp(),guild_id=message.guild.id if message.guild != None else None)
         if i in range(len(extracted_times)):
-            new_reminder.reminder_time = extracted_times[i].strftime("%H:%M:%S on %b %d, %Y")
+            new_reminder.reminder_time = extracted_times[i]
+            new_reminder.recurrence = recurrences[i]
         if i in range(len(reminder_messages)):
             new_reminder.info = reminder_messages[i]
-        if parse(new_reminder.reminder_time) < datetime.now():
-            error_message = message.author.mention + ' You cannot create a reminder set to go off in the past. The reminder \"{0}\" set to go off at {1} was not created.'.format(new_reminder.info, new_reminder.reminder_time)
-            await message.channel.send(error_message)
+        new_reminders.append(new_reminder)
+    now = time.time()
+    for new_reminder in new_reminders:
+        if new_reminder.reminder_time < now:
+            error_message = message.author.mention + ' You cannot create a reminder set to go off in the past. The reminder \"{0}\" set to go off at {1} was not created.'.format(new_reminder.info, format_time(new_reminder.reminder_time, zone))
+            if len(new_reminders) > 1:
+                error_message += ' None of the other reminders in your message were created either.'
+            await dispatcher.send(message.channel.id, error_message)
             return
-        if message.author not in user_reminders:
-            user_reminders[message.author] = []
-        elif len(user_reminders[message.author]) > reminder_limit:
-            error_message = message.author.mention + ' You have hit the limit on the maximum number of reminders that can be created. (' + str(reminder_limit) + '). '
-            error_message += 'Please delete a reminder before creating a new one.'
-            await message.channel.send(error_message)
+    user_limit = user_reminder_limits.get(message.author.id, reminder_limit)
+    if store.count_user_reminders(message.author.id) + len(new_reminders) > user_limit:
+        error_message = message.author.mention + ' You have hit the limit on the maximum number of reminders that can be created. (' + str(user_limit) + '). '
+        error_message += 'Please delete a reminder before creating a new one.'
+        await dispatcher.send(message.channel.id, error_message)
+        return
+    if message.guild != None:
+        guild_limit = guild_reminder_limits.get(message.guild.id, guild_reminder_limit)
+        if store.count_guild_reminders(message.guild.id) + len(new_reminders) > guild_limit:
+            error_message = message.author.mention + ' This server has hit the limit on the maximum number of reminders that can be created. (' + str(guild_limit) + '). '
+            error_message += 'Reminders can still be created in DMs with the bot.'
+            await dispatcher.send(message.channel.id, error_message)
             return
-        confirmation_message = '{0} A reminder has been created for \"{1}\" and has been set to go off at {2}. The timezone of the pi is: {4}\nReact to this message with these reactions to perform these commands:\n{3}'.format(message.author.mention, new_reminder.info, new_reminder.reminder_time, build_reaction_options(confirmation_options),time.tzname)
-        confirmation = await message.channel.send(confirmation_message)
+    store.add(new_reminders)
+    reminders_created.inc(len(new_reminders))
+    invalidate_list(message.author.id)
+    for new_reminder in new_reminders:
+        # later reminders are paged in by the scheduler
+        if new_reminder.reminder_time < scheduled_until:
+            schedule_reminder(new_reminder)
+    # then every confirmation is queued at once, each one needs its own message for its reactions
+    # the dispatcher sends them while the first one is awaited
+    confirmations = [dispatcher.send(message.channel.id, build_confirmation(message.author.mention, new_reminder, zone)) for new_reminder in new_reminders]
+    for new_reminder, future in zip(new_reminders, confirmations):
+        try:
+            confirmation = await future
+        except Exception:
+            continue
+        asyncio.create_task(add_reactions(confirmation, len(confirmation_options)))
         new_reminder.confirmation_id = confirmation.id
-        user_reminders[message.author].append(new_reminder)
-        # create task for sleeping and append to remind_tasks
-        reminder_tasks[new_reminder] = asyncio.create_task(run_reminder(new_reminder))
+        store.update(new_reminder)
     # debugging
-    # for key in user_reminders.keys():
-    #     for i in range(len(user_reminders[key])):
-    #         user_reminders[key][i].to_string()
+    # for reminder in store.get_user_reminders(message.author.id):
+    #     reminder.to_string()
+    return
+
+async def cancel_reminder(reminder):
+    store.remove(reminder, 'cancel')
+    invalidate_list(reminder.user_id)
+    reminders_cancelled.inc()
+    unschedule_reminder(reminder)
+    await asyncio.gather(dispatcher.delete(reminder.channel_id, reminder.message_id), dispatcher.delete(reminder.channel_id, reminder.confirmation_id))
+    result = mention(reminder.user_id) + ' The reminder for \"{0}\" set to go off at {1} has been deleted.'.format(reminder.info,format_time(reminder.reminder_time, user_timezone(reminder.user_id)))
+    await dispatcher.send(reminder.channel_id, result)
+    return
+
+# all of a user's reminders are removed at once and one message is sent for all of them
+async def cancel_all_reminders(user_id, channel_id):
+    reminders = store.remove_user_reminders(user_id)
+    reminders_cancelled.inc(len(reminders))
+    invalidate_list(user_id)
+    deletes = []
+    for reminder in reminders:
+        unschedule_reminder(reminder)
+        deletes.append(dispatcher.delete(reminder.channel_id, reminder.message_id))
+        deletes.append(dispatcher.delete(reminder.channel_id, reminder.confirmation_id))
+    await dispatcher.send(channel_id, mention(user_id) + ' All {0} of your reminders have been deleted.'.format(len(reminders)))
+    await asyncio.gather(*deletes)
+    return
+
+def get_reminder(user_id, content):
+    reminder = store.find_user_reminder(user_id, content)
+    if reminder == None and content.isdigit():
+        reminder = store.get_user_reminder(user_id, int(content)-1)
+    return reminder
+
+### DISPATCHER ###
+
+# refills rate tokens per second up to capacity
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # takes a token if there is one, otherwise returns how many seconds until there is
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+# every message the bot sends goes through here
+# each channel gets its own queue and rate limit, reminders due together in a channel are sent as one message
+class MessageDispatcher:
+    def __init__(self, get_channel, http):
+        self.get_channel = get_channel
+        self.http = http
+        # channel ID -> deque of [content, embed description, coalesce, future, time queued]
+        self.queues = {}
+        # channel ID -> task sending that channel's queue
+        self.workers = {}
+        # channel ID -> TokenBucket, for sends and for deletes
+        self.buckets = {}
+        self.delete_buckets = {}
+        self.edit_buckets = {}
+        self.global_bucket = TokenBucket(global_send_rate, global_send_rate)
+        self.sent = 0
+        # seconds from queueing to sent for recent messages
+        self.latencies = collections.deque(maxlen=1000)
+
+    # returns a future for the sent message, messages with coalesce set can be merged with other coalesced ones
+    def send(self, channel_id, content, description=None, coalesce=False):
+        future = asyncio.get_event_loop().create_future()
+        if channel_id not in self.queues:
+            self.queues[channel_id] = collections.deque()
+        self.queues[channel_id].append([content, description, coalesce, future, time.time()])
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self.run(channel_id))
+        return future
+
+    async def run(self, channel_id):
+        queue = self.queues[channel_id]
+        if channel_id not in self.buckets:
+            self.buckets[channel_id] = TokenBucket(channel_send_rate, channel_send_burst)
+        try:
+            while len(queue) > 0:
+                await self.wait_for_token(self.buckets[channel_id])
+                await self.wait_for_token(self.global_bucket)
+                await self.deliver(channel_id, self.next_batch(queue))
+        finally:
+            del self.workers[channel_id]
+            del self.queues[channel_id]
+
+    async def wait_for_token(self, bucket):
+        delay = bucket.take()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = bucket.take()
+        return
+
+    def next_batch(self, queue):
+        batch = [queue.popleft()]
+        if batch[0][2]:
+            length = len(batch[0][0])
+            while len(queue) > 0 and queue[0][2] and length + len(queue[0][0]) + 1 <= message_length_limit:
+                length += len(queue[0][0]) + 1
+                batch.append(queue.popleft())
+        return batch
+
+    async def deliver(self, channel_id, batch):
+        content = '\n'.join([item[0] for item in batch])
+        descriptions = [item[1] for item in batch if item[1] != None]
+        embed = None
+        if len(descriptions) > 0:
+            embed = discord.Embed(description = '\n'.join(descriptions), color = embed_color)
+        send_start = time.perf_counter()
+        try:
+            message = await self.get_channel(channel_id).send(content = content, embed = embed)
+        except Exception as error:
+            for item in batch:
+                if not item[3].done():
+                    item[3].set_exception(error)
+            return
+        discord_send_seconds.observe(time.perf_counter() - send_start)
+        self.sent += 1
+        for item in batch:
+            self.latencies.append(time.time() - item[4])
+            dispatch_seconds.observe(time.time() - item[4])
+            if not item[3].done():
+                item[3].set_result(message)
+        return
+
+    # deletes by ID so the message does not have to be fetched first
+    async def delete(self, channel_id, message_id):
+        if message_id == None:
+            return
+        if channel_id not in self.delete_buckets:
+            self.delete_buckets[channel_id] = TokenBucket(channel_delete_rate, channel_delete_burst)
+        await self.wait_for_token(self.delete_buckets[channel_id])
+        await self.wait_for_token(self.global_bucket)
+        delete_start = time.perf_counter()
+        try:
+            await self.http.delete_message(channel_id, message_id)
+        # already deleted, or someone else's message in DMs
+        except (discord.NotFound, discord.Forbidden):
+            pass
+        discord_delete_seconds.observe(time.perf_counter() - delete_start)
+        return
+
+    # edits by ID so the message does not have to be fetched first, description None removes the embed
+    async def edit(self, channel_id, message_id, content, description=None):
+        if channel_id not in self.edit_buckets:
+            self.edit_buckets[channel_id] = TokenBucket(channel_send_rate, channel_send_burst)
+        await self.wait_for_token(self.edit_buckets[channel_id])
+        await self.wait_for_token(self.global_bucket)
+        embed = None
+        if description != None:
+            embed = discord.Embed(description = description, color = embed_color).to_dict()
+        try:
+            await self.http.edit_message(channel_id, message_id, content = content, embed = embed)
+        except (discord.NotFound, discord.Forbidden):
+            pass
+        return
+
+    def queue_depth(self):
+        return sum([len(queue) for queue in self.queues.values()])
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        result = {'queue_depth' : self.queue_depth(), 'sent' : self.sent, 'p50_latency' : 0, 'p99_latency' : 0}
+        if len(latencies) > 0:
+            result['p50_latency'] = latencies[len(latencies) // 2]
+            result['p99_latency'] = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+        return result
+
+### SCHEDULER ###
+
+def schedule_reminder(reminder):
+    global scheduled_reminders, reminder_heap
+    entry = [reminder.reminder_time, next(reminder_counter), reminder]
+    scheduled_reminders[reminder] = entry
+    heapq.heappush(reminder_heap, entry)
+    # only wake the scheduler if this reminder is now the next one due
+    if reminder_heap[0] is entry and scheduler_wakeup != None:
+        scheduler_wakeup.set()
+    return
+
+def unschedule_reminder(reminder):
+    global scheduled_reminders, reminder_heap, cancelled_entries
+    entry = scheduled_reminders.pop(reminder, None)
+    if entry == None:
+        return
+    # mark the entry as cancelled, the scheduler discards it when it reaches the top of the heap
+    entry[-1] = None
+    cancelled_entries += 1
+    # rebuild the heap once cancelled entries make up most of it
+    if cancelled_entries > len(reminder_heap) // 2:
+        reminder_heap = [entry for entry in reminder_heap if entry[-1] != None]
+        heapq.heapify(reminder_heap)
+        cancelled_entries = 0
+    return
+
+def pop_due_reminders(now):
+    global scheduled_reminders, reminder_heap, cancelled_entries
+    due = []
+    while len(reminder_heap) > 0 and (reminder_heap[0][-1] == None or reminder_heap[0][0] <= now):
+        _, _, reminder = heapq.heappop(reminder_heap)
+        if reminder == None:
+            cancelled_entries -= 1
+        else:
+            del scheduled_reminders[reminder]
+            due.append(reminder)
+    return due
+
+# moves reminders due in the next schedule_window seconds from the store into the scheduler
+def page_in_reminders(now):
+    global scheduled_until
+    if now + schedule_window / 2 < scheduled_until:
+        return
+    for reminder in store.due_between(scheduled_until, now + schedule_window):
+        schedule_reminder(reminder)
+    scheduled_until = now + schedule_window
+    return
+
+# the first time a rule goes off after both previous and now, days and times of day are in the timezone zone
+def next_occurrence(rule, previous, now, zone):
+    period, days, time_of_day = rule
+    after = max(previous, now)
+    if period > 0 and days != 0:
+        # counted in local days from the previous occurrence so the time of day holds across daylight saving changes
+        step = period // 86400
+        day = local_datetime(previous, zone).replace(hour=0, minute=0, second=0, microsecond=0)
+        skipped = (local_datetime(after, zone) - day).days // step
+        for i in range(skipped, skipped + 3):
+            occurrence = local_timestamp(day + timedelta(days=i * step, seconds=time_of_day), zone)
+            if occurrence > after:
+                return occurrence
+        return None
+    if period > 0:
+        # occurrences missed while the bot was down are skipped
+        return previous + period * (int(max(now - previous, 0) // period) + 1)
+    day = local_datetime(after, zone).replace(hour=0, minute=0, second=0, microsecond=0)
+    for i in range(8):
+        occurrence = local_timestamp(day + timedelta(days=i, seconds=time_of_day), zone)
+        if days & (1 << (day + timedelta(days=i)).weekday()) and occurrence > after:
+            return occurrence
+    return None
+
+# recurring reminders move to their next occurrence and stay scheduled, the rest are removed from the store
+def finish_reminder(reminder, now):
+    firing_reminders.pop(reminder.reminder_id, None)
+    reminders_fired.inc()
+    invalidate_list(reminder.user_id)
+    if reminder.recurrence == None:
+        store.remove(reminder, 'fire')
+        return
+    # the reminder could have been cancelled while it was being sent
+    if store.reschedule(reminder, next_occurrence(reminder.recurrence, reminder.reminder_time, now, user_timezone(reminder.user_id))) and reminder.reminder_time < scheduled_until:
+        schedule_reminder(reminder)
+    return
+
+# seconds the oldest unfinished reminder is overdue, grows while the bot cannot keep up
+# reminders waiting for a digest slot or for the dispatcher's rate limits count, not only the ones still on the heap
+def scheduler_lag():
+    oldest = float('inf')
+    if len(firing_reminders) > 0:
+        oldest = next(iter(firing_reminders.values()))
+    if len(reminder_heap) > 0 and reminder_heap[0][-1] != None:
+        oldest = min(oldest, reminder_heap[0][0])
+    return max(0, time.time() - oldest) if oldest != float('inf') else 0
+
+# why new reminders are not being accepted, None if they are
+def admission_check():
+    if scheduler_lag() > admission_lag_limit:
+        return 'behind on sending reminders'
+    if dispatcher.queue_depth() > admission_queue_limit:
+        return 'sending too many messages'
+    return None
+
+# tells the channel a reminder was turned away without waiting on the send queue
+# nothing is sent while the queue itself is full, and a channel hears about it at most once per interval
+def notify_rejection(message, reason):
+    if reason == 'sending too many messages':
+        return
+    now = time.time()
+    if now - admission_notices.get(message.channel.id, 0) < admission_notice_interval:
+        return
+    admission_notices[message.channel.id] = now
+    admission_notices.move_to_end(message.channel.id)
+    if len(admission_notices) > admission_notice_limit:
+        admission_notices.popitem(last=False)
+    notice = dispatcher.send(message.channel.id, message.author.mention + ' The bot is ' + reason + ' right now, so your reminder was not created. Please try again in a few minutes.')
+    # nobody awaits the notice, so a failed send is dropped here instead of being logged as never retrieved
+    notice.add_done_callback(lambda future: future.cancelled() or future.exception())
+    return
+
+async def run_scheduler():
+    while True:
+        page_in_reminders(time.time())
+        due = pop_due_reminders(time.time())
+        # fire every due reminder as one batch without holding up the scheduler
+        if len(due) > 0:
+            task = asyncio.create_task(fire_reminders(due))
+            firing_tasks.add(task)
+            task.add_done_callback(firing_tasks.discard)
+        scheduler_wakeup.clear()
+        # wake up for the next reminder or to page in more reminders, whichever comes first
+        timeout = scheduled_until - schedule_window / 2 - time.time()
+        if len(reminder_heap) > 0:
+            timeout = min(reminder_heap[0][0] - time.time(), timeout)
+        timeout = max(timeout, 0)
+        # not wait_for, it can swallow a cancel that arrives as the event is set
+        timer = asyncio.get_event_loop().call_later(timeout, scheduler_wakeup.set)
+        try:
+            await scheduler_wakeup.wait()
+        finally:
+            timer.cancel()
+
+async def fire_reminders(reminders):
+    now = time.time()
+    for reminder in reminders:
+        scheduler_lag_seconds.observe(now - reminder.reminder_time)
+        # digest reminders that came due while the bot was down only count from now, they are not a sign of the bot falling behind
+        firing_reminders[reminder.reminder_id] = reminder.reminder_time if now - reminder.reminder_time <= late_threshold else now
+    # reminders that came due while the bot was down or falling behind are sent as digests
+    late = [reminder for reminder in reminders if now - reminder.reminder_time > late_threshold]
+    tasks = [run_reminder(reminder) for reminder in reminders if now - reminder.reminder_time <= late_threshold]
+    if len(late) > 0:
+        tasks.append(catch_up_reminders(late, now))
+    await asyncio.gather(*tasks)
+    return
+
+# one digest per channel and user, sent in due time order with at most catch_up_concurrency being sent at once
+async def catch_up_reminders(reminders, now):
+    # (channel ID, user ID) -> Reminder[], in order of each group's first reminder
+    groups = {}
+    for reminder in sorted(reminders, key=lambda reminder: (reminder.reminder_time, reminder.reminder_id)):
+        key = (reminder.channel_id, reminder.user_id)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(reminder)
+    await asyncio.gather(*[send_digest(group, now) for group in groups.values()])
+    return
+
+async def send_digest(reminders, now):
+    async with catch_up_slots:
+        header = mention(reminders[0].user_id) + ' These reminders were sent late:'
+        zone = user_timezone(reminders[0].user_id)
+        content = header
+        descriptions = []
+        # the reminders are finished even if the digest cannot be sent, like when the channel was deleted
+        try:
+            for reminder in reminders:
+                line = '\n\"{0}\" from {1}, late by {2}.'.format(reminder.info, format_time(reminder.creation_time, zone), format_duration(now - reminder.reminder_time))
+                link = '[Link]({0}) to the original message for \"{1}\".'.format(reminder_url(reminder), reminder.info)
+                # split long digests over several messages, a line too long on its own is sent by itself
+                if len(descriptions) > 0 and (len(content) + len(line) > message_length_limit or len('\n'.join(descriptions + [link])) > embed_length_limit):
+                    await dispatcher.send(reminder.channel_id, content, '\n'.join(descriptions))
+                    content = header
+                    descriptions = []
+                content += line
+                descriptions.append(link)
+            await dispatcher.send(reminders[0].channel_id, content, '\n'.join(descriptions))
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            print('Could not send the digest for channel {0}: {1}'.format(reminders[0].channel_id, error))
+    for reminder in reminders:
+        finish_reminder(reminder, now)
     return
 
 async def run_reminder(reminder):
-    global user_reminders, reminder_tasks
-    user = client.get_user(reminder.user_id)
-    result = '{0} Reminder for \"{1}\" from {2}.'.format(user.mention, reminder.info, reminder.creation_time) 
-    expiration = parse(reminder.reminder_time)
-    # check constantly with micro sleeps
-    # while datetime.now() < expiration:
-    #     await asyncio.sleep(0.1)
-    # big sleep optimization
-    if datetime.now() < expiration:
-        await asyncio.sleep((expiration - datetime.now()).total_seconds())
+    result = '{0} Reminder for \"{1}\" from {2}.'.format(mention(reminder.user_id), reminder.info, format_time(reminder.creation_time, user_timezone(reminder.user_id)))
+    # coalesced reminders share one embed, so each link says which reminder it belongs to
+    description = '[Link]({0}) to the original message for \"{1}\".'.format(reminder_url(reminder), reminder.info)
+    # a reminder that cannot be sent, like one in a deleted channel, is still finished so it does not stay in the store forever
     try:
-        message = await client.get_channel(reminder.channel_id).fetch_message(reminder.message_id)
-    except discord.NotFound: #send with no hyperlink
-        await client.get_channel(reminder.channel_id).send(result)
-    else: #send with hyperlink
-        embed = discord.Embed(
-            description = ' Here is a [link](' + message.jump_url + ') to the original message.',
-            color = 9570046
-            )
-        await client.get_channel(reminder.channel_id).send(content = result, embed = embed)
-    # clear global lists
-    user_reminders[user].remove(reminder)
-    del reminder_tasks[reminder]
+        await dispatcher.send(reminder.channel_id, result, description, coalesce = True)
+    except asyncio.CancelledError:
+        raise
+    except Exception as error:
+        print('Could not send reminder {0}: {1}'.format(reminder.reminder_id, error))
+    finish_reminder(reminder, time.time())
     return
 
-async def cancel_reminder(reminder):
-    global user_reminders, reminder_tasks
-    user = client.get_user(reminder.user_id)
-    user_reminders[user].remove(reminder)
-    reminder_tasks[reminder].cancel()
-    del reminder_tasks[reminder]
-    channel = client.get_channel(reminder.channel_id)
+### METRICS ###
+
+# counters only go up, value_function reads the count from somewhere else instead
+class Counter:
+    def __init__(self, name, description, value_function=None):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.value_function = value_function
+
+    def inc(self, amount=1):
+        self.value += amount
+        return
+
+    def render(self):
+        value = self.value_function() if self.value_function != None else self.value
+        return ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} counter'.format(self.name), '{0} {1}'.format(self.name, value)]
+
+# gauges are read from value_function when the metrics are rendered
+class Gauge:
+    def __init__(self, name, description, value_function):
+        self.name = name
+        self.description = description
+        self.value_function = value_function
+
+    def render(self):
+        return ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} gauge'.format(self.name), '{0} {1}'.format(self.name, self.value_function())]
+
+# cumulative buckets like prometheus histograms, observing is a bisect and two additions
+class Histogram:
+    def __init__(self, name, description, buckets=histogram_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        return
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} histogram'.format(self.name)]
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, '+Inf' if bound == float('inf') else bound, total))
+        lines.append('{0}_sum {1}'.format(self.name, self.sum))
+        lines.append('{0}_count {1}'.format(self.name, self.count))
+        return lines
+
+# prometheus text format
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+reminders_created = Counter('rmb_reminders_created_total', 'Reminders created.')
+reminders_fired = Counter('rmb_reminders_fired_total', 'Reminders fired, every occurrence of a recurring reminder counts.')
+reminders_cancelled = Counter('rmb_reminders_cancelled_total', 'Reminders deleted by their users.')
+reminders_rejected = Counter('rmb_reminders_rejected_total', 'Reminder messages turned away by admission control.')
+parse_seconds = Histogram('rmb_parse_seconds', 'Time to parse the times out of a reminder message, including waiting for a parser.')
+scheduler_lag_seconds = Histogram('rmb_scheduler_lag_seconds', 'Time between when a reminder was due and when it was fired.')
+discord_send_seconds = Histogram('rmb_discord_send_seconds', 'Time discord took to answer a message send.')
+discord_delete_seconds = Histogram('rmb_discord_delete_seconds', 'Time discord took to answer a message delete.')
+dispatch_seconds = Histogram('rmb_dispatch_seconds', 'Time from a message being queued to it being sent, including rate limiting.')
+metrics = [reminders_created, reminders_fired, reminders_cancelled, reminders_rejected, parse_seconds, scheduler_lag_seconds, discord_send_seconds, discord_delete_seconds, dispatch_seconds,
+           Counter('rmb_parse_fast_total', 'Reminder messages parsed by the fast path.', lambda: parse_stats['fast']),
+           Counter('rmb_parse_cache_hits_total', 'Reminder messages found in the parse cache.', lambda: parse_stats['hits']),
+           Counter('rmb_parse_cache_misses_total', 'Reminder messages sent to the parser pool.', lambda: parse_stats['misses']),
+           Counter('rmb_messages_sent_total', 'Messages sent, coalesced reminders count once.', lambda: dispatcher.sent if dispatcher != None else 0),
+           Gauge('rmb_dispatcher_queue_depth', 'Messages waiting to be sent.', lambda: dispatcher.queue_depth() if dispatcher != None else 0),
+           Gauge('rmb_scheduled_reminders', 'Reminders in the scheduler heap.', lambda: len(scheduled_reminders)),
+           Gauge('rmb_reminder_heap_entries', 'Scheduler heap entries, including cancelled ones not yet discarded.', lambda: len(reminder_heap)),
+           Gauge('rmb_creation_tasks', 'Messages being turned into reminders.', lambda: len(creation_tasks)),
+           Gauge('rmb_firing_tasks', 'Batches of due reminders being sent.', lambda: len(firing_tasks)),
+           Gauge('rmb_scheduler_lag_now_seconds', 'How late the next due reminder is.', scheduler_lag)]
+
+# answers every request on metrics_port with the metrics, whatever the path
+async def serve_metrics(reader, writer):
     try:
-        message = await channel.fetch_message(reminder.message_id)
-    except discord.NotFound:
+        await asyncio.wait_for(reader.readline(), metrics_timeout)
+        body = render_metrics().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError):
         pass
-    else:
-        await message.delete()
+    writer.close()
+    return
+
+async def run_metrics():
+    # each shard serves its own metrics on the next port
+    # the port is shared with the old process for the moment both are running during a restart
+    if metrics_port != None:
+        try:
+            await asyncio.start_server(serve_metrics, metrics_host, metrics_port + shard_id, reuse_port=True)
+        except OSError as error:
+            print('Could not serve metrics: {0}'.format(error))
+    if metrics_file == None:
+        return
+    while True:
+        await asyncio.sleep(metrics_interval)
+        # written to a temporary file first so readers never see half of it
+        temp_file = shard_file(metrics_file) + '.tmp'
+        with open(temp_file, 'w') as outfile:
+            outfile.write(render_metrics())
+        os.replace(temp_file, shard_file(metrics_file))
+
+# samples the event loop thread's stack from another thread, off until toggled with SIGUSR1
+# stacks are counted in the collapsed format flame graph tools read: "file:function;file:function count"
+class SamplingProfiler:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = collections.Counter()
+        self.running = False
+        self.thread = None
+
+    def toggle(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.write(shard_file(profile_file))
+            print('Stopped the profiler, wrote {0} samples to {1}.'.format(sum(self.stacks.values()), shard_file(profile_file)))
+        else:
+            self.stacks = collections.Counter()
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            print('Started the profiler.')
+        return
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame != None:
+                stack.append('{0}:{1}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(profile_interval)
+        return
+
+    def write(self, file_name):
+        with open(file_name, 'w') as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write('{0} {1}\n'.format(stack, count))
+        return
+
+### SHARDING ###
+
+def start_shard(shard, count):
+    environment = dict(os.environ)
+    environment['RMB_SHARD_ID'] = str(shard)
+    environment['RMB_SHARD_COUNT'] = str(count)
+    # in its own session so a ctrl-c in the terminal only reaches the supervisor, which forwards it once
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=environment, start_new_session=True)
+
+# each shard saves its reminders on a single interrupt, a second one could cut the save short
+def stop_shards(shards):
+    for process in shards:
+        if process.poll() == None:
+            process.send_signal(signal.SIGINT)
+    for process in shards:
+        process.wait()
+    return
+
+# runs one bot process per shard and restarts them when they exit
+def run_supervisor(count):
+    shards = [start_shard(shard, count) for shard in range(count)]
+    print('Started {0} shards.'.format(count))
     try:
-        confirmation = await channel.fetch_message(reminder.confirmation_id)
-    except discord.NotFound:
-        pass
-    else:
-        await confirmation.delete()
-    result = user.mention + ' The reminder for \"{0}\" set to go off at {1} has been deleted.'.format(reminder.info,reminder.reminder_time)
-    await channel.send(result)
-    return
-
-def get_reminder(user, content):
-    global user_reminders
-    if user in user_reminders:
-        for reminder in user_reminders[user]:
-            if content == reminder.info:
-                return reminder
-        if content.isdigit():
-            if int(content)-1 < len(user_reminders[user]):
-                return user_reminders[user][int(content)-1]
-    return None
+        while True:
+            time.sleep(1)
+            for shard in range(count):
+                returncode = shards[shard].poll()
+                if returncode == None:
+                    continue
+                # every shard is restarted after an update so none of them keeps running the old code
+                if returncode == restart_exit_code:
+                    print('Updating and restarting all shards.')
+                    if os.path.isdir('.git'):
+                        subprocess.call(['git', 'pull'])
+                    stop_shards(shards)
+                    shards = [start_shard(shard, count) for shard in range(count)]
+                    break
+                print('Shard {0} exited with {1}, restarting it in {2} seconds.'.format(shard, returncode, shard_restart_delay))
+                time.sleep(shard_restart_delay)
+                shards[shard] = start_shard(shard, count)
+    except KeyboardInterrupt:
+        stop_shards(shards)
+    return
 
 ### MAIN ###
 
 def main():
+    global store, dispatcher, start_time, catch_up_slots, profiler
+    # python3.7 remindmebot.py <number of shards>
+    if len(sys.argv) > 1 and sys.argv[1].isdigit() and 'RMB_SHARD_COUNT' not in os.environ and int(sys.argv[1]) > 1:
+        run_supervisor(int(sys.argv[1]))
+        return
+    start_time = time.time()
     setup_tokens(tokens_file)
-    # setup existing reminders, read from save_file
+    dispatcher = MessageDispatcher(client.get_channel, client.http)
+    catch_up_slots = asyncio.Semaphore(catch_up_concurrency)
+    profiler = SamplingProfiler(threading.get_ident())
+    asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+    start_parser_pool()
+    # existing reminders are read from the store once the client is ready
+    # when taking over from an old process the store is opened after it has closed it
+    if '--handoff' not in sys.argv:
+        store = open_store()
     try:
         asyncio.get_event_loop().run_until_complete(client.start(discord_token))
     except KeyboardInterrupt:
-        save_reminders(save_file)
+        save_reminders()
+        store.close()
         asyncio.get_event_loop().run_until_complete(client.logout())
     finally:
+        parser_pool.shutdown()
         asyncio.get_event_loop().close()
+    sys.exit(exit_code)
 
 if __name__ == "__main__": main()
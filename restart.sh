@@ -2,4 +2,4 @@
 if [ -d .git ]; then
     git pull
 fi
-python3.7 remindmebot.py
+python3.7 remindmebot.py "$@"